@@ -0,0 +1,187 @@
+import sys
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+import filters
+import special_filters_for_scene as special
+import suppotr_functions as sup
+import lut
+
+# Filters applied to a stack of equal images N x H x W (x C) with one call for the whole stack
+# instead of a python loop over the images. A filter without a stacked version is applied image by image.
+
+
+def stack_imgs(imgs):
+    # one contiguous array of the images or None if their shapes or types differ
+    if len(imgs) == 0 or any(not isinstance(img, np.ndarray) for img in imgs):
+        return None
+    if any(img.shape != imgs[0].shape or img.dtype != imgs[0].dtype for img in imgs):
+        return None
+    return np.stack(imgs)
+
+
+def rows(stack):
+    # the stack as one 2d image of N * H rows, for opencv functions working pixel by pixel
+    return stack.reshape(stack.shape[0] * stack.shape[1], -1)
+
+
+def image_axes(stack):
+    return tuple(range(1, stack.ndim))
+
+
+def normalize(stack, a, b):
+    # cv2.normalize(NORM_MINMAX) of each float32 image of the stack, in place
+    lo = stack.min(axis=image_axes(stack), keepdims=True)
+    span = stack.max(axis=image_axes(stack), keepdims=True) - lo
+    eps = np.finfo(np.float64).eps
+    scale = np.where(span > eps, (b - a) / np.where(span > eps, span, 1), 0).astype(np.float32)
+    stack -= lo
+    stack *= scale
+    stack += a
+    return stack
+
+
+def lut_stack(stack, table):
+    if stack.dtype == np.uint16:
+        return np.take(table, stack)
+    return cv2.LUT(rows(stack), table).reshape(stack.shape)
+
+
+def thresholding(stack, threshold=125):
+    white = sup.depth_max(stack.dtype)
+    _, res = cv2.threshold(rows(stack), threshold * white / 255, white, cv2.THRESH_BINARY)
+    return res.reshape(stack.shape)
+
+
+def gradation_correction(stack, k=255):
+    mn = stack - np.min(stack, axis=image_axes(stack), keepdims=True)
+    eps = 0.01
+    mx = np.max(mn, axis=image_axes(stack), keepdims=True)
+    img_stand = np.divide(mn, np.where(mx > 0, mx, eps))
+    img_stand *= k
+    return sup.from_8bit(img_stand, stack.dtype)
+
+
+def bitwise_and(stacks):
+    if stacks[0].dtype.kind == 'f':
+        return sup.float_bitwise(np.bitwise_and, stacks)
+    return cv2.bitwise_and(rows(stacks[0]), rows(stacks[1])).reshape(stacks[0].shape)
+
+
+def bitwise_or(stacks):
+    if stacks[0].dtype.kind == 'f':
+        return sup.float_bitwise(np.bitwise_or, stacks)
+    return cv2.bitwise_or(rows(stacks[0]), rows(stacks[1])).reshape(stacks[0].shape)
+
+
+def bitwise_xor(stacks):
+    if stacks[0].dtype.kind == 'f':
+        return sup.float_bitwise(np.bitwise_xor, stacks)
+    return cv2.bitwise_xor(rows(stacks[0]), rows(stacks[1])).reshape(stacks[0].shape)
+
+
+def bitwise_not(stack):
+    if stack.dtype.kind == 'f':
+        return sup.depth_max(stack.dtype) - stack
+    return cv2.bitwise_not(rows(stack)).reshape(stack.shape)
+
+
+def homomorf_filtering(stack, d_0=80, gamma_l=0.25, gamma_h=2):
+    mask = sup.homomorf_mask(stack[0], d_0, gamma_l, gamma_h)
+    scale = 255 / sup.depth_max(stack.dtype)
+    idft_stack = normalize(sup.freq_filter(stack, mask, log=True, stacked=True, scale=scale), 0, 1)
+    new_stack = normalize(np.exp(idft_stack, out=idft_stack), 0, sup.depth_max(stack.dtype))
+    return new_stack.astype(sup.depth_type(stack.dtype))
+
+
+def gauss_high_freq_filter(stack, d_0=80):
+    mask = sup.gauss_high_freq_mask(stack[0], d_0)
+    idft_stack = normalize(sup.freq_filter(stack, mask, stacked=True), 0, sup.depth_max(stack.dtype))
+    return idft_stack.astype(sup.depth_type(stack.dtype))
+
+
+def ideal_high_freq_filter(stack, d_0=80):
+    mask = sup.ideal_high_freq_mask(stack[0], d_0)
+    idft_stack = normalize(sup.freq_filter(stack, mask, stacked=True), 0, sup.depth_max(stack.dtype))
+    return idft_stack.astype(sup.depth_type(stack.dtype))
+
+
+# (module, name) of a filter -> its version for stacks, lut filters of uint8 and uint16 stacks
+# are applied by their table
+STACK_FILTERS = {
+    ('filters', 'thresholding'): thresholding,
+    ('filters', 'gradation_correction'): gradation_correction,
+    ('filters', 'homomorf_filtering'): homomorf_filtering,
+    ('filters', 'gauss_high_freq_filter'): gauss_high_freq_filter,
+    ('filters', 'ideal_high_freq_filter'): ideal_high_freq_filter,
+    ('special_filters_for_scene', 'bitwise_and'): bitwise_and,
+    ('special_filters_for_scene', 'bitwise_or'): bitwise_or,
+    ('special_filters_for_scene', 'bitwise_xor'): bitwise_xor,
+    ('special_filters_for_scene', 'bitwise_not'): bitwise_not,
+}
+
+
+def filter_key(func):
+    return getattr(func, '__module__', None), getattr(func, '__name__', None)
+
+
+def is_stack_filter(func):
+    return filter_key(func) in STACK_FILTERS or lut.is_lut_filter(func)
+
+
+def apply_stacked(func, stack, args):
+    # func applied to every image of the stack (a list of stacks for a filter of several images)
+    first = stack[0] if isinstance(stack, list) else stack
+    if lut.is_lut_filter(func) and first.dtype in (np.uint8, np.uint16) and not isinstance(stack, list):
+        return lut_stack(stack, lut.filter_lut(func, args, sup.depth_max(first.dtype)))
+    if filter_key(func) in STACK_FILTERS:
+        return STACK_FILTERS[filter_key(func)](stack, **lut.filter_args(func, args))
+    if isinstance(stack, list):
+        return np.stack([func(list(imgs), **args) for imgs in zip(*stack)])
+    return np.stack([func(img, **args) for img in stack])
+
+
+def benchmark(n=32, shape=(512, 512, 3), repeat=3):
+    # time of the per image loop and of the stacked call for every stacked filter
+    rng = np.random.default_rng(0)
+    imgs = [rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(n)]
+    others = [rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(n)]
+    stack, other_stack = stack_imgs(imgs), stack_imgs(others)
+    cases = [
+        (filters.gamma_correction, {'gamma': 2.5}),
+        (filters.linear_hist_transform, {'k': 1.5, 'b': 10}),
+        (filters.thresholding, {'threshold': 125}),
+        (filters.gradation_correction, {'k': 255}),
+        (filters.gauss_high_freq_filter, {'d_0': 80}),
+        (filters.ideal_high_freq_filter, {'d_0': 80}),
+        (filters.homomorf_filtering, {}),
+        (special.bitwise_and, {}),
+        (special.bitwise_xor, {}),
+        (special.bitwise_not, {}),
+    ]
+    print(f"{n} images {'x'.join(map(str, shape))}, best of {repeat}")
+    print(f"{'filter':<28}{'per image, ms':>15}{'stacked, ms':>15}{'max diff':>10}")
+    for func, args in cases:
+        pair = func.__name__.startswith('bitwise') and func.__name__ != 'bitwise_not'
+        loop_times, stack_times = [], []
+        for _ in range(repeat):
+            start = perf_counter()
+            if pair:
+                res = [func([img, other], **args) for img, other in zip(imgs, others)]
+            else:
+                res = [func(img, **args) for img in imgs]
+            loop_times.append(perf_counter() - start)
+
+            start = perf_counter()
+            stack_res = apply_stacked(func, [stack, other_stack] if pair else stack, args)
+            stack_times.append(perf_counter() - start)
+        diff = np.abs(np.stack(res).astype(np.int64) - stack_res.astype(np.int64)).max()
+        print(f"{func.__name__:<28}{1000 * min(loop_times):>15.1f}{1000 * min(stack_times):>15.1f}{diff:>10}")
+
+
+if __name__ == '__main__':
+    # python batch_filters.py [number of images] [image size]
+    n, size = (int(arg) for arg in (sys.argv[1:] + ["32", "512"][len(sys.argv) - 1:])[:2])
+    benchmark(n, (size, size, 3))
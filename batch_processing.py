@@ -0,0 +1,236 @@
+import os
+import pickle
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+import cv2
+
+worker_plan = None
+
+
+def result_name(img_name, i):
+    suf_ind = img_name.find('.')
+    return f"{img_name[:suf_ind]}_{i}{img_name[suf_ind:]}"
+
+
+def init_worker(plan):
+    global worker_plan
+    worker_plan = plan
+    # processes already give the parallelism, opencv threads would only compete with them
+    cv2.setNumThreads(1)
+
+
+def read_img(path, flags=cv2.IMREAD_COLOR):
+    # IMREAD_UNCHANGED keeps 16 bit and float images for the high bit depth mode
+    img = cv2.imread(str(path), flags)
+    if img is None:
+        raise IOError(f"Can't read image {path}")
+    return img
+
+
+def write_imgs(path, save_dir, res_imgs):
+    names = []
+    for i, res_img in enumerate(res_imgs):
+        name = result_name(Path(path).name, i)
+        cv2.imwrite(str(Path(save_dir) / name), res_img)
+        names.append(name)
+    return names
+
+
+def process_file(path, save_dir, plan=None, flags=cv2.IMREAD_COLOR):
+    plan = plan if plan is not None else worker_plan
+    return write_imgs(path, save_dir, plan.run(read_img(path, flags)))
+
+
+class BatchProcessor:
+    def __init__(self, plan, paths, save_dir, workers=None, flags=cv2.IMREAD_COLOR):
+        self.plan = plan
+        self.paths = list(paths)
+        self.save_dir = save_dir
+        self.workers = workers if workers else os.cpu_count()
+        self.flags = flags
+
+        self.executor = None
+        self.futures = dict()
+        self.pending = iter(self.paths)
+        self.done = 0
+        self.errors = []
+        self.cancelled = False
+
+    def start(self):
+        # spawn keeps the gui state of the parent process out of the workers
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=init_worker, initargs=(self.plan,))
+        # only a couple of tasks per worker are queued, the rest are submitted as results come back
+        self.submit(2 * self.workers)
+
+    def submit(self, n):
+        for path in self.pending:
+            self.futures[self.executor.submit(process_file, path, self.save_dir, None, self.flags)] = path
+            n -= 1
+            if n == 0:
+                break
+
+    def poll(self):
+        finished = []
+        for future in [future for future in self.futures if future.done()]:
+            path = self.futures.pop(future)
+            if future.cancelled():
+                continue
+            error = future.exception()
+            if error is not None:
+                self.errors.append((path, error))
+                finished.append((path, None))
+            else:
+                finished.append((path, future.result()))
+        self.done += len(finished)
+        if not self.cancelled:
+            self.submit(len(finished))
+        if self.finished():
+            self.executor.shutdown(wait=False)
+        return finished
+
+    def wait(self):
+        wait(list(self.futures), return_when=FIRST_COMPLETED)
+        return self.poll()
+
+    def finished(self):
+        return not self.futures
+
+    def cancel(self):
+        self.cancelled = True
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class StreamProcessor:
+    # reader -> processing -> writer threads connected by bounded queues,
+    # so only about 2 * prefetch + 2 images are in memory at any moment
+    def __init__(self, plan, paths, save_dir, prefetch=4, flags=cv2.IMREAD_COLOR):
+        self.plan = plan
+        self.paths = list(paths)
+        self.save_dir = save_dir
+        self.flags = flags
+
+        self.read_queue = queue.Queue(prefetch)
+        self.write_queue = queue.Queue(prefetch)
+        self.done_queue = queue.Queue()
+        self.threads = []
+
+        self.done = 0
+        self.errors = []
+        self.cancelled = False
+
+    def start(self):
+        for stage in (self.read, self.process, self.write):
+            self.threads.append(threading.Thread(target=stage, daemon=True))
+            self.threads[-1].start()
+
+    def put(self, stage_queue, item):
+        while not self.cancelled:
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, stage_queue):
+        while not self.cancelled:
+            try:
+                return stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def read(self):
+        for path in self.paths:
+            try:
+                item = (path, read_img(path, self.flags), None)
+            except Exception as e:
+                item = (path, None, e)
+            if not self.put(self.read_queue, item):
+                return
+        self.put(self.read_queue, None)
+
+    def process(self):
+        while True:
+            item = self.get(self.read_queue)
+            if item is None:
+                break
+            path, img, error = item
+            res_imgs = None
+            if error is None:
+                try:
+                    res_imgs = self.plan.run(img)
+                except Exception as e:
+                    error = e
+            if not self.put(self.write_queue, (path, res_imgs, error)):
+                return
+        self.put(self.write_queue, None)
+
+    def write(self):
+        while True:
+            item = self.get(self.write_queue)
+            if item is None:
+                break
+            path, res_imgs, error = item
+            names = None
+            if error is None:
+                try:
+                    names = write_imgs(path, self.save_dir, res_imgs)
+                except Exception as e:
+                    error = e
+            self.done_queue.put((path, names, error))
+
+    def poll(self):
+        finished = []
+        while True:
+            try:
+                path, names, error = self.done_queue.get_nowait()
+            except queue.Empty:
+                break
+            if error is not None:
+                self.errors.append((path, error))
+            finished.append((path, names))
+        self.done += len(finished)
+        return finished
+
+    def wait(self):
+        while not self.finished() and self.done_queue.empty():
+            self.threads[-1].join(0.1)
+        return self.poll()
+
+    def finished(self):
+        if self.done == len(self.paths):
+            return True
+        return self.cancelled and not any(thread.is_alive() for thread in self.threads) and self.done_queue.empty()
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def estimate_peak(plan, path, workers=None, flags=cv2.IMREAD_COLOR):
+    # every worker runs the plan on its own image
+    workers = workers if workers else os.cpu_count()
+    return plan.estimate_peak(read_img(path, flags)) * workers
+
+
+def spawn_safe(plan):
+    # filters added from a file live in a module the spawned workers can't import,
+    # such a plan can't be sent to them
+    try:
+        pickle.dumps(plan)
+    except Exception:
+        return False
+    return True
+
+
+def make_processor(plan, paths, save_dir, workers=None, flags=cv2.IMREAD_COLOR):
+    workers = workers if workers else os.cpu_count()
+    if workers == 1 or not spawn_safe(plan):
+        return StreamProcessor(plan, paths, save_dir, flags=flags)
+    return BatchProcessor(plan, paths, save_dir, workers, flags)
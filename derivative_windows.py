@@ -1,10 +1,14 @@
-from PyQt5.QtWidgets import (QWidget, QLabel, QMainWindow, QSizePolicy,
+from PyQt5.QtWidgets import (QWidget, QLabel, QMainWindow, QSizePolicy, QCheckBox,
                              QPushButton, QGridLayout, QLineEdit, QTextEdit, QScrollArea)
 from PyQt5.QtGui import QFont, QImage, QPixmap, QPalette
-import cv2
+from PyQt5.QtCore import QTimer
 import func2action
+from preview import to_rgb
+from suppotr_functions import standart
+from jobs import JobManager
 
 FONT_SIZE = 16
+PREVIEW_DELAY = 300
 
 
 class FilterArgWindow(QMainWindow):
@@ -14,6 +18,13 @@ class FilterArgWindow(QMainWindow):
         self.method = method
         self.centralWidget = QWidget(self)
         self.edits = None
+        self.preview_box = None
+        # previews run on the shown part of the current image, a new one replaces the stale run
+        self.preview_jobs = JobManager(self)
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DELAY)
+        self.preview_timer.timeout.connect(self.start_preview)
         self.initGui()
 
     def initGui(self):
@@ -29,20 +40,63 @@ class FilterArgWindow(QMainWindow):
             label = QLabel(arg)
             edit = QLineEdit()
             self.edits[arg] = edit
+            edit.textChanged.connect(self.schedule_preview)
             grid.addWidget(label, i, 0)
             grid.addWidget(edit, i, 1)
 
+        self.preview_box = QCheckBox("Live preview")
+        self.preview_box.setStatusTip("Show the filter on the visible part of the current image")
+        self.preview_box.toggled.connect(self.schedule_preview)
+        grid.addWidget(self.preview_box, len(self.method.args), 0, 1, 2)
+
         apply_button = QPushButton("Apply")
         apply_button.clicked.connect(self.apply)
-        grid.addWidget(apply_button, len(self.method.args), 0)
+        grid.addWidget(apply_button, len(self.method.args) + 1, 0)
 
         cancel_button = QPushButton("Cancel")
         cancel_button.clicked.connect(self.cancel)
-        grid.addWidget(cancel_button, len(self.method.args), 1)
+        grid.addWidget(cancel_button, len(self.method.args) + 1, 1)
 
         self.resize(100, 100)
         self.setWindowTitle(f'Argument function {self.method.name}')
 
+    def schedule_preview(self):
+        if self.preview_box.isChecked():
+            self.preview_timer.start()
+        else:
+            self.stop_preview()
+
+    def start_preview(self):
+        img_window = self.parent.img_window
+        if img_window.img is None:
+            return
+        try:
+            action_args = {arg: float(edit.text()) for arg, edit in self.edits.items()}
+        except ValueError:
+            self.statusBar().showMessage("Incorrect arguments")
+            return
+        img, rect = img_window.visible_img()
+        if img is None:
+            return
+        self.statusBar().clearMessage()
+        self.preview_jobs.start("preview", self.preview_filter, self.method, img, action_args,
+                                self.parent.convert_result(),
+                                on_finished=lambda res: img_window.set_preview(res, rect),
+                                on_error=lambda error: self.statusBar().showMessage(f"Error: {error}"))
+
+    @staticmethod
+    def preview_filter(job, method, img, action_args, convert=standart):
+        return convert(method.func(img, **action_args))
+
+    def stop_preview(self):
+        self.preview_timer.stop()
+        self.preview_jobs.cancel_all()
+        self.parent.img_window.clear_preview()
+
+    def closeEvent(self, event):
+        self.stop_preview()
+        super().closeEvent(event)
+
     def cancel(self):
         self.parent.action_args = None
         self.close()
@@ -205,7 +259,12 @@ class TestImageWindow(QMainWindow):
         self.setWindowTitle("Test Image")
 
     def set_img(self):
-        frame = cv2.cvtColor(self.img, cv2.COLOR_BGR2RGB)
+        frame = to_rgb(self.img)
         img = QImage(frame, frame.shape[1], frame.shape[0], frame.strides[0], QImage.Format_RGB888)
         self.img_pixmap = QPixmap.fromImage(img)
         self.img_label.setPixmap(self.img_pixmap)
+
+    def update_img(self, img):
+        self.img = img
+        self.set_img()
+        self.setWindowTitle("Test Image")
@@ -191,11 +191,19 @@ class NodeItem(QGraphicsItem):
 
 
 class GraphicsScene(QGraphicsScene):
+    # nodes whose inputs were connected, disconnected or deleted
+    graph_changed = QtCore.pyqtSignal(list)
+
     startItem = newConnection = None
     edges = []
     delete_flag = False
     deleted_items = set()
 
+    @staticmethod
+    def input_parents(points):
+        parents = [point.parent for point in points if point.input_flag]
+        return parents if parents else [point.parent for point in points]
+
     def removeEdge(self, new_edge):
         for edge in self.edges:
             if new_edge.equal(edge):
@@ -226,8 +234,10 @@ class GraphicsScene(QGraphicsScene):
                 return
             if item:
                 new_edges = []
+                changed = []
                 for edge in self.edges:
                     if item in edge.controlParents():
+                        changed += [node for node in self.input_parents(edge.controlPoints()) if node is not item]
                         if not edge.start.removeEdge(edge):
                             edge.end.removeEdge(edge)
                     else:
@@ -235,6 +245,7 @@ class GraphicsScene(QGraphicsScene):
                 self.edges = new_edges
                 self.deleted_items.add(item)
                 self.removeItem(item)
+                self.graph_changed.emit(changed)
                 return
 
         super().mousePressEvent(event)
@@ -263,6 +274,7 @@ class GraphicsScene(QGraphicsScene):
                     item.removeEdge(self.newConnection)
                     self.removeItem(self.newConnection)
                     self.removeEdge(self.newConnection)
+                self.graph_changed.emit(self.input_parents([self.startItem, item]))
             else:
                 self.removeItem(self.newConnection)
         self.startItem = self.newConnection = None
@@ -6,14 +6,18 @@ import numpy as np
 import cv2
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QGraphicsView, QGraphicsEllipseItem, QGraphicsRectItem,
                              QGraphicsProxyWidget, QGridLayout, QLabel, QLineEdit, QVBoxLayout, QHBoxLayout,
-                             QPushButton, QWidget, QAction, QFileDialog, QToolButton, QToolBar, QMessageBox, QScrollArea)
+                             QPushButton, QWidget, QAction, QFileDialog, QToolButton, QToolBar, QMessageBox, QScrollArea,
+                             QProgressDialog)
 from PyQt5.QtGui import QPainter, QIcon, QColor, QFont
-from PyQt5.QtCore import QSize, Qt
+from PyQt5.QtCore import QSize, Qt, QTimer
 from PyQt5 import QtCore, QtWidgets
 
-from suppotr_functions import standart
+from suppotr_functions import standart, keep_depth
 import func2action
 import special_filters_for_scene
+import graph_executor
+import batch_processing
+from jobs import JobManager
 from filter_box_scene import NodeItem, GraphicsScene, Edge
 from derivative_windows import TestImageWindow, ImgInfoWindow
 
@@ -28,12 +32,27 @@ class ConstructorWindow(QMainWindow):
         self.font.setPointSize(FONT_SIZE)
         self.basic_action_seq = basic_action_seq
 
-        self.imgs = []
+        self.img_paths = []
         self.img_names = []
-        self.res_imgs = []
+        self.save_path = None
+
+        self.jobs = JobManager(self)
+        self.processor = None
+        self.progress_dialog = None
+        self.progress_timer = None
 
         self.test_img_windows = []
         self.test_img = None
+        self.test_img_key = None
+        # results of the graph nodes on the test image, a view recomputes only the changed nodes
+        self.results = graph_executor.ResultCache()
+        # nodes with open test image windows, edits make the windows of the downstream nodes outdated
+        self.node_windows = dict()
+        self.stale = set()
+        self.auto_run = False
+        self.refresh_timer = None
+        # set by the main window, images are read with IMREAD_UNCHANGED and keep 16 bit and float types
+        self.high_depth = False
 
         self.delete_flag = False
 
@@ -105,7 +124,7 @@ class ConstructorWindow(QMainWindow):
         get_test_img_action.triggered.connect(self.get_test_img)
 
         save_imgs_action = QAction(QIcon(str(icons_folder / "save.png")), "&Save", self)
-        save_imgs_action.setStatusTip("Save")
+        save_imgs_action.setStatusTip("Choose where to save the results")
         save_imgs_action.triggered.connect(self.get_save_path)
 
         start_alg_action = QAction(QIcon(str(icons_folder / "start.jpg")), "&Start", self)
@@ -116,6 +135,11 @@ class ConstructorWindow(QMainWindow):
         save_script_action.setStatusTip("Save script")
         save_script_action.triggered.connect(self.save_script)
 
+        auto_run_action = QAction("&Auto run", self)
+        auto_run_action.setCheckable(True)
+        auto_run_action.setStatusTip("Update the shown test images after every change of the graph")
+        auto_run_action.toggled.connect(self.set_auto_run)
+
         delete_node_action = QToolButton(self)
         delete_node_action.setIcon(QIcon(str(icons_folder / "delete_node.png")))
         delete_node_action.setCheckable(True)
@@ -135,6 +159,13 @@ class ConstructorWindow(QMainWindow):
 
         self.add_2_tool_bar(test_action, "test_action")
         self.add_2_tool_bar(start_alg_action, "Start image processing")
+        self.add_2_tool_bar(auto_run_action, "Auto run")
+
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(300)
+        self.refresh_timer.timeout.connect(self.refresh_stale)
+        self.my_scene.graph_changed.connect(self.mark_stale)
 
         self.formatbar = QToolBar(self)
         self.addToolBar(Qt.TopToolBarArea, self.formatbar)
@@ -166,20 +197,25 @@ class ConstructorWindow(QMainWindow):
         self.output_nodes.add(nodes[-1])
 
     def get_imgs(self):
-        self.imgs = []
-        self.res_imgs = []
+        self.img_paths = []
+        self.img_names = []
         filenames = QFileDialog.getOpenFileNames()[0]
         if filenames != "":
             for filename in filenames:
-                img = cv2.imread(filename)
-                self.imgs.append(img)
+                self.img_paths.append(filename)
                 self.img_names.append(Path(filename).name)
 
+    def read_flags(self):
+        return cv2.IMREAD_UNCHANGED if self.high_depth else cv2.IMREAD_COLOR
+
     def get_test_img(self):
         self.test_img_windows.clear()
         filename = QFileDialog.getOpenFileName()[0]
         if filename != "":
-            self.test_img = cv2.imread(filename)
+            self.node_windows.clear()
+            self.test_img = cv2.imread(filename, self.read_flags())
+            if self.test_img is not None:
+                self.test_img_key = graph_executor.img_key(self.test_img)
 
     def update_delete_flag(self):
         self.delete_flag = not self.delete_flag
@@ -198,7 +234,8 @@ class ConstructorWindow(QMainWindow):
 
     def get_save_path(self):
         save_path = QFileDialog.getSaveFileName()[0]
-        self.save_imgs(Path(save_path).parents[0])
+        if save_path != "":
+            self.save_path = Path(save_path).parents[0]
 
     def add_2_tool_bar(self, action, descr):
         tool = self.addToolBar(descr)
@@ -222,6 +259,8 @@ class ConstructorWindow(QMainWindow):
         self.my_scene.addItem(node)
         node.filterBox.filterWidget.setFont(self.font)
         node.view_button.clicked.connect(partial(self.test_processing, node=node))
+        for edit in node.filterBox.filterWidget.edits.values():
+            edit.textChanged.connect(lambda text, node=node: self.mark_stale([node]))
         return node
 
     def add_filters(self):
@@ -229,29 +268,24 @@ class ConstructorWindow(QMainWindow):
 
         for method in self.funcs_list:
             button = QPushButton(method.name)
-            n_in, n_out = self.io_points(method.name)
+            n_in, n_out = graph_executor.io_points(method.name)
             button.clicked.connect(partial(self.newNode, filter=method, n_in=n_in, n_out=n_out))
             button.setStatusTip(method.description)
             self.filters_box.addWidget(button)
 
     @staticmethod
-    def io_points(func_name):
-        if func_name == 'split':
-            return 1, 2
-        if func_name == 'input':
-            return 0, 1
-        if func_name == 'output':
-            return 1, 0
-        if 'bitwise' == func_name[:7] and ('not' not in func_name) or ('sum' in func_name):
-            return 2, 1
-        return 1, 1
-
-    @staticmethod
-    def box2filter_with_args(node):
+    def box2args(node):
         filter_args = dict()
         for arg in node.filterBox.filterWidget.edits:
-            filter_args[arg] = float(node.filterBox.filterWidget.edits[arg].text())
-        return partial(node.filter.func, **filter_args)
+            filter_args[arg] = node.filterBox.filterWidget.edits[arg].text()
+        return filter_args
+
+    @staticmethod
+    def show_error(text):
+        error_message = QMessageBox()
+        error_message.setText("Error")
+        error_message.setInformativeText(text)
+        error_message.exec_()
 
     def create_graph(self):
         graph = dict()
@@ -267,68 +301,135 @@ class ConstructorWindow(QMainWindow):
                     break
         return graph
 
-    def apply_img(self, orig_img, graph, out_node):
-        #graph = self.create_graph()
-        queue_nodes = list(self.input_nodes)
-        node_with_imgs = dict()
-        for node in self.input_nodes:
-            node_with_imgs[node] = [orig_img.copy()]
-
-        while queue_nodes:
-            node = queue_nodes.pop(0)
-            imgs = node_with_imgs[node]
+    def create_plan(self, out_node=None):
+        nodes = dict()
+        for node in self.input_nodes | self.output_nodes:
+            nodes[node] = None
+        for edge in self.my_scene.edges:
+            for point in edge.controlPoints():
+                nodes[point.parent] = None
+        for node in nodes:
+            nodes[node] = graph_executor.GraphNode(node.filter.name, node.filter.func, self.box2args(node),
+                                                   node.n_in, node.n_out)
 
-            if node.n_in != len(imgs) and node.n_in != 0:
-                queue_nodes.append(node)
-                continue
-            output = self.box2filter_with_args(node)(imgs if node.n_in > 1 else imgs[0])
-            new_imgs = output if node.n_out > 1 else [output]
-            if node.n_out == 0:
-                continue
-            if out_node and node is out_node:
-                return new_imgs
-
-            # assert len(new_imgs) == len(graph[node]), "incorrect graph"
-
-            for i in range(len(graph[node])):
-                if graph[node][i] not in node_with_imgs:
-                    node_with_imgs[graph[node][i]] = [new_imgs[i]]
-                else:
-                    node_with_imgs[graph[node][i]].append(new_imgs[i])
-                if len(node_with_imgs[graph[node][i]]) == graph[node][i].n_in:
-                    queue_nodes.append(graph[node][i])
-        res = []
-        for out in self.output_nodes:
-            res.append(node_with_imgs[out][0])
-        return res
+        edges = []
+        for edge in self.my_scene.edges:
+            start, end = edge.controlPoints()
+            if start.input_flag == end.input_flag:
+                raise graph_executor.GraphError("Edges must connect an output with an input")
+            if start.input_flag:
+                start, end = end, start
+            edges.append((nodes[start.parent], start.parent.out_points.index(start),
+                          nodes[end.parent], end.parent.inp_points.index(end)))
+
+        if out_node is not None and out_node not in nodes:
+            raise graph_executor.GraphError(f"{out_node.filter.name} is not connected")
+        target = nodes[out_node] if out_node is not None else None
+        return graph_executor.compile_plan(list(nodes.values()), edges, target)
 
     def start_processing(self):
-        graph = self.create_graph()
-        for img in self.imgs:
-            res_imgs = self.apply_img(img, graph, None)
-            self.res_imgs.append(res_imgs)
-            '''for i in range(len(res_imgs)):
-                suf_ind = filename.find('.')
-                cv2.imwrite(f"{filename[:suf_ind]}_{i}{filename[suf_ind:]}", res_imgs[i])'''
-
-    def save_imgs(self, path):
-        for img_name, res_img in zip(self.img_names, self.res_imgs):
-            for i in range(len(res_img)):
-                suf_ind = img_name.find('.')
-                cv2.imwrite(str(path / f"{img_name[:suf_ind]}_{i}{img_name[suf_ind:]}"), res_img[i])
+        if not self.img_paths:
+            self.show_error("Please select images")
+            return
+        try:
+            plan = self.create_plan()
+        except graph_executor.GraphError as e:
+            self.show_error(str(e))
+            return
+        if self.save_path is None:
+            self.get_save_path()
+            if self.save_path is None:
+                return
+
+        messages = []
+        try:
+            peak = batch_processing.estimate_peak(plan, self.img_paths[0], flags=self.read_flags())
+            messages.append(f"Estimated peak memory: {peak / 2**20:.0f} MiB")
+        except Exception as e:
+            messages.append(f"Peak memory can't be estimated: {e}")
+        if plan.fused():
+            messages.append(f"Fused filters: {'; '.join(plan.fused())}")
+        self.statusBar().showMessage(". ".join(messages))
+
+        self.processor = batch_processing.make_processor(plan, self.img_paths, self.save_path,
+                                                         flags=self.read_flags())
+        try:
+            self.processor.start()
+        except Exception as e:
+            self.processor.cancel()
+            self.processor = None
+            self.show_error(f"Can't start processing: {e}")
+            return
+
+        self.progress_dialog = QProgressDialog("Processing images", "Cancel", 0, len(self.img_paths), self)
+        self.progress_dialog.setWindowModality(Qt.WindowModal)
+        self.progress_dialog.canceled.connect(self.cancel_processing)
+        self.progress_dialog.show()
+
+        self.progress_timer = QTimer(self)
+        self.progress_timer.timeout.connect(self.update_processing)
+        self.progress_timer.start(100)
+
+    def update_processing(self):
+        self.processor.poll()
+        self.progress_dialog.setValue(self.processor.done)
+        if self.processor.finished():
+            self.progress_timer.stop()
+            self.progress_dialog.reset()
+            if self.processor.errors:
+                self.show_error(f"{len(self.processor.errors)} images were not processed")
+            self.statusBar().showMessage(f"Processed {self.processor.done} images")
+
+    def cancel_processing(self):
+        if self.processor is not None and not self.processor.finished():
+            self.progress_timer.stop()
+            self.processor.cancel()
+            self.statusBar().showMessage(f"Processing cancelled after {self.processor.done} images")
 
     def test(self):
         if self.test_img is not None:
             # self.test_img_windows.clear()
-            graph = self.create_graph()
-            res = self.apply_img(self.test_img, graph, None)
-            for i, img in enumerate(res):
-                cv2.imwrite(f"test_img_{i}.jpeg", img)
+            try:
+                plan = self.create_plan()
+            except graph_executor.GraphError as e:
+                self.show_error(str(e))
+                return
+            self.statusBar().showMessage("Processing the test image")
+            self.jobs.start("test", self.run_plan, plan, self.test_img, self.results, self.test_img_key,
+                            on_finished=self.save_test_imgs, on_error=self.show_processing_error)
         else:
-            error_message = QMessageBox()
-            error_message.setText("Error")
-            error_message.setInformativeText("Please select a test image")
-            error_message.exec_()
+            self.show_error("Please select a test image")
+
+    @staticmethod
+    def run_plan(job, plan, img, cache=None, key=None):
+        return plan.run(img, cache, key)
+
+    def save_test_imgs(self, res):
+        for i, img in enumerate(res):
+            cv2.imwrite(f"test_img_{i}.jpeg", img)
+        self.statusBar().showMessage("Test images save")
+
+    def show_test_imgs(self, node, res):
+        self.statusBar().clearMessage()
+        convert = keep_depth if self.high_depth else standart
+        windows = self.node_windows.get(node, [])
+        if len(windows) == len(res) and all(window.isVisible() for window in windows):
+            for window, img in zip(windows, res):
+                window.update_img(convert(img))
+            return
+        windows = []
+        for img in res:
+            img = convert(img)
+            # if np.min(img) < 0 or np.max(img) > 255:
+            windows.append(TestImageWindow(img))
+            #img_window.setParent(self)
+            windows[-1].show()
+        self.test_img_windows += windows
+        self.node_windows[node] = windows
+
+    def show_processing_error(self, error):
+        self.statusBar().clearMessage()
+        self.show_error("An error occurred while processing the image.")
 
     '''def test(self):
         graph = self.create_graph()
@@ -340,27 +441,69 @@ class ConstructorWindow(QMainWindow):
     def test_processing(self, node):
         if self.test_img is not None:
             #self.test_img_windows.clear()
-            graph = self.create_graph()
             try:
-                res = self.apply_img(self.test_img, graph, node)
-            except Exception:
-                error_message = QMessageBox()
-                error_message.setText("Error")
-                error_message.setInformativeText("An error occurred while processing the image.")
-                error_message.exec_()
+                plan = self.create_plan(node)
+            except graph_executor.GraphError as e:
+                self.show_error(str(e))
                 return
-
-            for img in res:
-                img = standart(img)
-                # if np.min(img) < 0 or np.max(img) > 255:
-                self.test_img_windows.append(TestImageWindow(img))
-                #img_window.setParent(self)
-                self.test_img_windows[-1].show()
+            self.view_node(node, plan, self.show_processing_error)
         else:
-            error_message = QMessageBox()
-            error_message.setText("Error")
-            error_message.setInformativeText("Please select a test image")
-            error_message.exec_()
+            self.show_error("Please select a test image")
+
+    def view_node(self, node, plan, on_error):
+        self.stale.discard(node)
+        self.statusBar().showMessage(f"Processing the test image up to {node.filter.name}")
+        self.jobs.start(("view", node), self.run_plan, plan, self.test_img, self.results, self.test_img_key,
+                        on_finished=partial(self.show_test_imgs, node), on_error=on_error)
+
+    def downstream(self, nodes):
+        children = dict()
+        for edge in self.my_scene.edges:
+            start, end = edge.controlPoints()
+            if start.input_flag:
+                start, end = end, start
+            children.setdefault(start.parent, []).append(end.parent)
+
+        found = set()
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            if node not in found:
+                found.add(node)
+                stack += children.get(node, [])
+        return found
+
+    def mark_stale(self, nodes):
+        self.node_windows = {node: windows for node, windows in self.node_windows.items()
+                             if node not in self.my_scene.deleted_items
+                             and all(window.isVisible() for window in windows)}
+        self.stale &= self.node_windows.keys()
+        self.stale |= self.downstream(nodes) & self.node_windows.keys()
+        for node in self.stale:
+            for window in self.node_windows[node]:
+                window.setWindowTitle("Test Image (outdated)")
+        if self.auto_run:
+            self.refresh_timer.start()
+
+    def set_auto_run(self, flag):
+        self.auto_run = flag
+        if flag:
+            self.refresh_timer.start()
+
+    def refresh_stale(self):
+        # only the outdated windows are updated, unchanged upstream nodes come from the result cache
+        if self.test_img is None:
+            return
+        for node in list(self.stale):
+            if node not in self.node_windows:
+                self.stale.discard(node)
+                continue
+            try:
+                plan = self.create_plan(node)
+            except graph_executor.GraphError as e:
+                self.statusBar().showMessage(f"{node.filter.name}: {e}")
+                continue
+            self.view_node(node, plan, lambda error: self.statusBar().showMessage(f"Error: {error}"))
 
     def open_script(self):
         #open_script_path = QFileDialog.getSaveFileName()[0]
@@ -400,10 +543,7 @@ class ConstructorWindow(QMainWindow):
         try:
             graph = self.create_graph()
         except Exception:
-            error_message = QMessageBox()
-            error_message.setText("Error")
-            error_message.setInformativeText("Please create correct script")
-            error_message.exec_()
+            self.show_error("Please create correct script")
         if graph:
             save_script_path = QFileDialog.getSaveFileName()[0]
             #save_script_path = "/home/pashnya/Documents/test/test.txt"
@@ -0,0 +1,60 @@
+import func2action
+import special_filters_for_scene
+from graph_executor import GraphError, GraphNode, io_points
+
+
+def script_funcs(extra_funcs=None):
+    funcs = dict()
+    for func in func2action.all_func() + func2action.all_spec_func(special_filters_for_scene) + (extra_funcs or []):
+        funcs[func.name] = func
+    return funcs
+
+
+def read_script(path, funcs):
+    # format of ConstructorWindow.save_script: number of nodes, "name#arg:value#" per node,
+    # then for every node the indices of its children
+    with open(path) as f:
+        lines = f.read().split('\n')
+    n = int(lines[0])
+    if len(lines) < 2 * n + 1:
+        raise GraphError(f"Script {path} is truncated")
+
+    nodes = []
+    for line in lines[1:n + 1]:
+        inp = line.split('#')
+        name = inp[0]
+        if name not in funcs:
+            raise GraphError(f"Unknown filter {name}")
+        args = dict([(x.split(':')[0], x.split(':')[1]) for x in inp[1:-1] if ':' in x])
+        n_in, n_out = io_points(name)
+        nodes.append(GraphNode(name, funcs[name].func, args, n_in, n_out))
+
+    edges = []
+    free_inputs = [0] * n
+    for i, line in enumerate(lines[n + 1:2 * n + 1]):
+        for k, child in enumerate(line.split()):
+            child = int(child)
+            if free_inputs[child] >= nodes[child].n_in:
+                raise GraphError(f"Too many inputs for {nodes[child].name}")
+            edges.append((nodes[i], k if nodes[i].n_out > 1 else 0, nodes[child], free_inputs[child]))
+            free_inputs[child] += 1
+
+    return nodes, edges
+
+
+def write_action_seq(path, action_seq, depth=False):
+    # the sequence is stored as a chain input -> filters -> output, so it can be run like any script,
+    # every filter is followed by the conversion of MainWindow.apply_filter as in compile_chain
+    convert = "keep depth#" if depth else "standart#"
+    names = ["input#"]
+    for method, action_args in action_seq:
+        names.append(method.name + "#" + "".join(f"{arg}:{value}#" for arg, value in action_args.items()))
+        names.append(convert)
+    names.append("output#")
+
+    with open(path, 'w') as f:
+        f.write(f"{len(names)}\n")
+        for name in names:
+            f.write(f"{name}\n")
+        for i in range(len(names)):
+            f.write(f"{i + 1} \n" if i + 1 < len(names) else "\n")
@@ -2,38 +2,45 @@ import cv2
 import numpy as np
 from scipy import ndimage
 import suppotr_functions as sup
+import lut
 
 
-def gaussian_blur(img=None, kernel_size=3, sigma=0):
+# filters with the keyword-only dst argument write the result into dst when it has the right shape and type.
+# uint16 and float32 (0..1) images keep their type, arguments in intensity units are given for 0..255.
+
+
+def gaussian_blur(img=None, kernel_size=3, sigma=0, *, dst=None):
     kernel_size = int(kernel_size)
 
-    return cv2.GaussianBlur(img, (kernel_size, kernel_size), sigmaX=sigma, sigmaY=sigma)
+    return cv2.GaussianBlur(img, (kernel_size, kernel_size), sigmaX=sigma, sigmaY=sigma, dst=dst)
 
 
-def average_blur(img=None, kernel_size=3):
+def average_blur(img=None, kernel_size=3, *, dst=None):
     kernel_size = int(kernel_size)
 
-    return cv2.blur(img, (kernel_size, kernel_size))
+    return cv2.blur(img, (kernel_size, kernel_size), dst=dst)
 
 
-def bilateral_filter(img=None, kernel_size=5, sigma_color=75, sigma_space=75):
+def bilateral_filter(img=None, kernel_size=5, sigma_color=75, sigma_space=75, *, dst=None):
     kernel_size = int(kernel_size)
 
-    return cv2.bilateralFilter(img, kernel_size, sigma_color, sigma_space)
+    if img.dtype == np.uint8:
+        return cv2.bilateralFilter(img, kernel_size, sigma_color, sigma_space, dst=dst)
+    # opencv has no 16 bit bilateral filter
+    sigma_color = sigma_color * sup.depth_max(img.dtype) / 255
+    res = cv2.bilateralFilter(img.astype(np.float32, copy=False), kernel_size, sigma_color, sigma_space)
+    return sup.saturate(res, img.dtype, out=dst)
 
 
-def gamma_correction(img=None, gamma=2.5):
-    c = 255
-    matrix = np.array([np.uint8(np.clip(c * ((i / 255.0) ** gamma), 0, 255)) for i in np.arange(0, 256)]).astype("uint8")
-
-    return cv2.LUT(img, matrix)
+def gamma_correction(img=None, gamma=2.5, *, dst=None):
+    return lut.apply(img, lut.gamma_curve, gamma, dst=dst)
 
 
 def gradation_correction(img=None, k=255):
     mn = img - np.min(img)
     eps = 0.01
     img_stand = k * (mn / (np.max(mn) if np.max(mn) > 0 else eps))
-    return sup.standart(img_stand)
+    return sup.from_8bit(img_stand, img.dtype)
 
 
 def gray(img=None):
@@ -62,8 +69,9 @@ def exact_crop(img=None, x=0, y=0, width=None, height=None):
     return img[y:y + height, x:x + width]
 
 
-def thresholding(img=None, threshold=125):
-    _, thresh1 = cv2.threshold(img, threshold, 255, cv2.THRESH_BINARY)
+def thresholding(img=None, threshold=125, *, dst=None):
+    white = sup.depth_max(img.dtype)
+    _, thresh1 = cv2.threshold(img, threshold * white / 255, white, cv2.THRESH_BINARY, dst=dst)
     return thresh1
 
 
@@ -74,101 +82,90 @@ def rotate_img(img=None, angle=90):
 
 def sob(img=None):
     blur = cv2.GaussianBlur(img, (3, 3), 0)
-    sobel_X = lambda image: np.uint8(np.abs(cv2.Sobel(image, cv2.CV_64F, 1, 0)))
-    sobel_Y = lambda image: np.uint8(np.abs(cv2.Sobel(image, cv2.CV_64F, 0, 1)))
+    if img.dtype == np.uint8:
+        sobel_X = lambda image: np.uint8(np.abs(cv2.Sobel(image, cv2.CV_64F, 1, 0)))
+        sobel_Y = lambda image: np.uint8(np.abs(cv2.Sobel(image, cv2.CV_64F, 0, 1)))
+    else:
+        sobel_X = lambda image: sup.saturate(np.abs(cv2.Sobel(image, cv2.CV_32F, 1, 0)), image.dtype)
+        sobel_Y = lambda image: sup.saturate(np.abs(cv2.Sobel(image, cv2.CV_32F, 0, 1)), image.dtype)
 
-    sob = cv2.bitwise_or(sobel_X(blur), sobel_Y(blur))
+    combine = cv2.max if img.dtype.kind == 'f' else cv2.bitwise_or
+    sob = combine(sobel_X(blur), sobel_Y(blur))
 
     return sob
 
 
 def laplasiian(img=None):
-    new_img = cv2.GaussianBlur(img, (3, 3), 0)
-
+    #new_img = cv2.GaussianBlur(img, (3, 3), 0)
     #new_img1 = standart(np.int64(img) - 3 * cv2.Laplacian(new_img, cv2.CV_64F))
     #new_img2 = standart(np.int64(new_img) - 1 * cv2.Laplacian(new_img, cv2.CV_64F))
     #new_img3 = standart(np.int64(img) - 1 * cv2.Laplacian(img, cv2.CV_64F))
-    new_img4 = sup.standart(np.int64(new_img) - 1 * cv2.Laplacian(img, cv2.CV_64F))
-    return np.int64(cv2.Laplacian(img, cv2.CV_64F))
-    #return cv.convertScaleAbs(cv2.Laplacian(img, cv2.CV_64F))
+    #new_img4 = standart(np.int64(new_img) - 1 * cv2.Laplacian(img, cv2.CV_64F))
 
-
-def equalization_hist(img=None):
-    return cv2.equalizeHist(img)
+    # the laplacian of an uint8 image is an exact integer within int16,
+    # uint16 and float images keep their type with negative values cut as standart would do
+    if img.dtype == np.uint8:
+        return cv2.Laplacian(img, cv2.CV_16S)
+    return sup.saturate(cv2.Laplacian(img, cv2.CV_32F), img.dtype)
+    #return cv.convertScaleAbs(cv2.Laplacian(img, cv2.CV_64F))
 
 
-def linear_hist_transform(img=None, k=1, b=0):
-    matrix = np.array([np.uint8(np.clip(k * i + b, 0, 255)) for i in np.arange(0, 256)]).astype(
-        "uint8")
-    return cv2.LUT(img, matrix)
+def equalization_hist(img=None, *, dst=None):
+    if img.dtype.kind == 'f':
+        # a float image is equalized as a 16 bit one
+        res = equalization_hist(sup.saturate(np.rint(img * 65535), np.uint16))
+        return sup.saturate(res / 65535, img.dtype, out=dst)
+    if img.dtype != np.uint16:
+        return cv2.equalizeHist(img, dst=dst)
+    # opencv equalizes only 8 bit images, the same table built from the 16 bit histogram
+    cdf = np.cumsum(np.bincount(img.ravel(), minlength=65536))
+    cdf_min = cdf[np.argmax(cdf > 0)]
+    scale = 65535 / (img.size - cdf_min) if img.size > cdf_min else 0
+    table = np.rint((cdf - cdf_min) * scale).clip(0, 65535).astype(np.uint16)
+    return np.take(table, img, out=dst)
 
 
-def piecewise_linear_3_transform(img=None, x1=0.5, y1=0.5, x2=0.5, y2=0.5):
-    matrix = np.zeros((256, 1), dtype=np.uint8)
-    for i in range(256):
-        if i < x1 * 255:
-            matrix[i] = i * (y1 / x1)
-        elif i < x2 * 255:
-            matrix[i] = (i - 255 * x1) * (y2 - y1) / (x2 - x1) + y1 * 255
-        else:
-            matrix[i] = (i - 255) * (y2 - 1) * (x2 - 1) + 255
+def linear_hist_transform(img=None, k=1, b=0, *, dst=None):
+    return lut.apply(img, lut.linear_curve, k, b, dst=dst)
 
-        if matrix[i] < 0:
-            matrix[i] = 0
-        if matrix[i] > 255:
-            matrix[i] = 255
 
-    return cv2.LUT(img, matrix)
+def piecewise_linear_3_transform(img=None, x1=0.5, y1=0.5, x2=0.5, y2=0.5, *, dst=None):
+    return lut.apply(img, lut.piecewise_linear_3_curve, x1, y1, x2, y2, dst=dst)
 
 
 def DFT(img=None):
     mag, _ = sup.DFT(img)
-    return mag
+    return sup.from_8bit(mag, img.dtype)
 
 
 def homomorf_filtering(img=None, d_0=80, gamma_l=0.25, gamma_h=2):
-    eps = 10**(-6)
-    ln_img = np.log(img + eps)
-
-    _, dft_shift = sup.DFT(ln_img)
-
     mask = sup.homomorf_mask(img, d_0, gamma_l, gamma_h)
-    fshift = dft_shift * mask
-
-    idft_img = sup.iDFT(fshift)
-
-    #idft_img = idft_img.copy()
+    # the log is taken of 0..255 levels whatever the bit depth
+    idft_img = sup.freq_filter(img, mask, log=True, scale=255 / sup.depth_max(img.dtype))
 
     cv2.normalize(idft_img, idft_img, 0, 1, cv2.NORM_MINMAX)
 
-    new_img = np.exp(idft_img).copy()
-    cv2.normalize(new_img, new_img, 0, 255, cv2.NORM_MINMAX)
-    new_img = new_img.astype(np.uint8)
+    new_img = np.exp(idft_img, out=idft_img)
+    cv2.normalize(new_img, new_img, 0, sup.depth_max(img.dtype), cv2.NORM_MINMAX)
+    new_img = new_img.astype(sup.depth_type(img.dtype))
     return new_img
 
 
 def gauss_high_freq_filter(img=None, d_0=80):
-    _, dft_shift = sup.DFT(img)
     mask = sup.gauss_high_freq_mask(img, d_0)
-    fshift = dft_shift * mask
+    idft_img = sup.freq_filter(img, mask)
 
-    idft_img = sup.iDFT(fshift)
-
-    cv2.normalize(idft_img, idft_img, 0, 255, cv2.NORM_MINMAX)
-    idft_img = idft_img.astype(np.uint8)
+    cv2.normalize(idft_img, idft_img, 0, sup.depth_max(img.dtype), cv2.NORM_MINMAX)
+    idft_img = idft_img.astype(sup.depth_type(img.dtype))
     return idft_img
 
 
 def ideal_high_freq_filter(img=None, d_0=80):
-    _, dft_shift = sup.DFT(img)
     mask = sup.ideal_high_freq_mask(img, d_0)
+    idft_img = sup.freq_filter(img, mask)
 
-    fshift = dft_shift * mask
-
-    idft_img = sup.iDFT(fshift)
-
-    cv2.normalize(idft_img, idft_img, 0, 255, cv2.NORM_MINMAX)
-    idft_img = idft_img.astype(np.uint8)
+    cv2.normalize(idft_img, idft_img, 0, sup.depth_max(img.dtype), cv2.NORM_MINMAX)
+    idft_img = idft_img.astype(sup.depth_type(img.dtype))
     return idft_img
 
 
@@ -1,6 +1,7 @@
 from inspect import getfullargspec, isfunction, getmembers
 import importlib.util
 import sys
+from pathlib import Path
 import filters
 import img_specifications
 
@@ -28,7 +29,7 @@ class Func:
 
 def all_func():
     descriptions = dict()
-    with open('filters_description.txt') as f:
+    with open(Path(__file__).parent / 'filters_description.txt') as f:
         for line in f:
             name, descr = line.split(': ')
             descriptions[name] = descr
@@ -0,0 +1,484 @@
+import functools
+import hashlib
+import threading
+import tracemalloc
+from collections import deque, Counter, OrderedDict
+from inspect import signature, Parameter
+
+import numpy as np
+import cv2
+
+import lut
+from suppotr_functions import standart, keep_depth
+
+
+class GraphError(Exception):
+    pass
+
+
+def io_points(func_name):
+    if func_name == 'split':
+        return 1, 2
+    if func_name == 'input':
+        return 0, 1
+    if func_name == 'output':
+        return 1, 0
+    if 'bitwise' == func_name[:7] and ('not' not in func_name) or ('sum' in func_name):
+        return 2, 1
+    return 1, 1
+
+
+def read_only(img):
+    # a view, so the flags of the caller's array stay as they are
+    view = img.view()
+    view.flags.writeable = False
+    return view
+
+
+def mutates_input(func):
+    # a filter changing its input in place declares it with func.inplace = True and gets its own copy
+    return getattr(func, 'inplace', False)
+
+
+def writes_dst(func):
+    try:
+        param = signature(func).parameters.get('dst')
+    except (TypeError, ValueError):
+        return False
+    return param is not None and param.kind == Parameter.KEYWORD_ONLY
+
+
+def memory_owner(img):
+    while isinstance(img.base, np.ndarray):
+        img = img.base
+    return img
+
+
+class BufferPool:
+    # arrays of released buffers by shape and type, given again as dst to filters that accept it.
+    # An array goes back to the pool only when no slot holds it or a view of it.
+    def __init__(self):
+        self.free = dict()
+        self.owned = dict()
+        self.holders = Counter()
+
+    def get(self, shape, dtype):
+        free = self.free.get((shape, dtype))
+        buf = free.pop() if free else np.empty(shape, dtype)
+        buf.flags.writeable = True
+        self.owned[id(buf)] = buf
+        return buf
+
+    def put(self, buf):
+        if self.owned.pop(id(buf), None) is not None:
+            self.free.setdefault((buf.shape, buf.dtype), []).append(buf)
+
+    def hold(self, img):
+        if isinstance(img, np.ndarray):
+            self.holders[id(memory_owner(img))] += 1
+
+    def release(self, img):
+        if not isinstance(img, np.ndarray):
+            return
+        owner = memory_owner(img)
+        self.holders[id(owner)] -= 1
+        if self.holders[id(owner)] == 0:
+            del self.holders[id(owner)]
+            self.put(owner)
+
+
+class GraphNode:
+    def __init__(self, name, func, args, n_in, n_out):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.n_in = n_in
+        self.n_out = n_out
+
+
+class Step:
+    def __init__(self, name, func, args, inputs, outputs, n_in, n_out):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.inputs = inputs
+        self.outputs = outputs
+        self.n_in = n_in
+        self.n_out = n_out
+        self.writes_dst = n_out == 1 and writes_dst(func)
+
+    def __call__(self, imgs, dst=None):
+        if mutates_input(self.func):
+            imgs = [img.copy() for img in imgs]
+        args = self.args if dst is None else dict(self.args, dst=dst)
+        output = self.func(imgs if self.n_in > 1 else imgs[0], **args)
+        return output if self.n_out > 1 else [output]
+
+
+class LutStep(Step):
+    # chain of pointwise filters applied as one cv2.LUT pass with the composed table,
+    # an uint16 image goes through the composed 16 bit table built on first use
+    def __init__(self, steps, table):
+        self.filters = [step.name for step in steps if step.func not in (standart, keep_depth)]
+        super().__init__(" + ".join(self.filters), None, {}, steps[0].inputs, steps[-1].outputs, 1, 1)
+        self.steps = steps
+        self.table = table
+        self.table16 = None
+        self.writes_dst = True
+
+    def __call__(self, imgs, dst=None):
+        img = imgs[0]
+        if img.dtype == np.uint8:
+            return [cv2.LUT(img, self.table, dst=dst)]
+        # standart makes an uint8 image of the uint16 one, so it can't be a 16 bit table
+        if img.dtype == np.uint16 and all(step.func is not standart for step in self.steps):
+            if self.table16 is None:
+                tables = [lut.filter_lut(step.func, step.args, 65535) for step in self.steps]
+                self.table16 = functools.reduce(lut.compose, tables)
+            return [np.take(self.table16, img, out=dst)]
+        for step in self.steps:
+            img = step([img])[0]
+        return [img]
+
+
+class ExecutionPlan:
+    def __init__(self, steps, n_slots, input_slots, result_slots):
+        self.steps = fuse_pointwise_steps(steps, result_slots)
+        self.n_slots = n_slots
+        self.input_slots = input_slots
+        self.result_slots = result_slots
+        self.release = plan_release(self.steps, result_slots)
+
+    def fused(self):
+        return [step.name for step in self.steps if isinstance(step, LutStep) and len(step.filters) > 1]
+
+    def run(self, img, cache=None, key=None):
+        # Buffers are read-only and shared by all their consumers, a buffer is released after its last consumer.
+        # Without a cache, released arrays are reused as dst of the following steps.
+        # With a cache, a step takes the stored result of the same filter and arguments on the same inputs.
+        buffers = [None] * self.n_slots
+        keys = [None] * self.n_slots
+        pool = BufferPool() if cache is None else None
+        if cache is not None and key is None:
+            key = img_key(img)
+        img = read_only(img)
+        for slot in self.input_slots:
+            buffers[slot] = img
+            keys[slot] = key
+            if pool is not None:
+                pool.hold(img)
+
+        for i, step in enumerate(self.steps):
+            inputs = [buffers[slot] for slot in step.inputs]
+            if cache is None:
+                dst = pool.get(inputs[0].shape, inputs[0].dtype) if step.writes_dst else None
+                new_imgs = step(inputs, dst)
+                if dst is not None and new_imgs[0] is not dst:
+                    pool.put(dst)
+            else:
+                res_key = result_key(step, [keys[slot] for slot in step.inputs])
+                new_imgs = cache.get(res_key)
+                if new_imgs is None:
+                    new_imgs = step(inputs)
+                    cache.put(res_key, new_imgs)
+                for port, slot in enumerate(step.outputs):
+                    keys[slot] = f"{res_key}:{port}"
+            del inputs
+
+            for slot, new_img in zip(step.outputs, new_imgs):
+                if isinstance(new_img, np.ndarray):
+                    new_img.flags.writeable = False
+                buffers[slot] = new_img
+                if pool is not None:
+                    pool.hold(new_img)
+            for slot in self.release[i]:
+                if pool is not None:
+                    pool.release(buffers[slot])
+                buffers[slot] = None
+
+        return [buffers[slot] for slot in self.result_slots]
+
+    def estimate_peak(self, img, sample_size=64):
+        # Bytes of the image, the buffers alive at once and the temporaries of the running filter.
+        # The plan runs on a reduced copy and every buffer is scaled by the area of the same buffer
+        # of the full size run, the temporaries (fft buffers, float copies) are the peak numpy allocation
+        # traced by tracemalloc during the step. Filters giving an image of a fixed size run with their
+        # size arguments reduced as the image, their output is counted with the size they give for the full image.
+        h, w = img.shape[:2]
+        k = sample_size / max(h, w)
+        if k < 1:
+            img = cv2.resize(img, (max(1, int(w * k)), max(1, int(h * k))), interpolation=cv2.INTER_AREA)
+
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        try:
+            buffers = [None] * self.n_slots
+            shapes = [None] * self.n_slots
+            sizes = [0] * self.n_slots
+            for slot in self.input_slots:
+                buffers[slot] = img
+                shapes[slot] = (h, w)
+            live = peak = img.nbytes * area_scale((h, w), img)
+            for i, step in enumerate(self.steps):
+                inputs = [buffers[slot] for slot in step.inputs]
+                shape = shapes[step.inputs[0]]
+                sample = sample_step(step, shape, inputs[0].shape[:2])
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                new_imgs = (step if sample is None else sample[0])(inputs)
+                temporaries = tracemalloc.get_traced_memory()[1] - before
+                own = 0
+                scales = [area_scale(shape, inputs[0])]
+                for slot, new_img in zip(step.outputs, new_imgs):
+                    buffers[slot] = new_img
+                    if sample is not None:
+                        shapes[slot] = sample[1]
+                    else:
+                        shapes[slot] = scaled_shape(new_img, shape, inputs[0])
+                    scales.append(area_scale(shapes[slot], new_img))
+                    if not any(np.may_share_memory(new_img, inp) for inp in inputs):
+                        sizes[slot] = new_img.nbytes * scales[-1]
+                        own += sizes[slot]
+                del new_imgs
+                peak = max(peak, live + max(own, temporaries * max(scales)))
+                live += own
+                for slot in self.release[i]:
+                    live -= sizes[slot]
+                    buffers[slot] = None
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+        return peak
+
+
+def area_scale(shape, img):
+    # area of the full size buffer of this (h, w) to the area of its reduced copy
+    if not isinstance(img, np.ndarray) or img.ndim < 2 or img.shape[0] * img.shape[1] == 0:
+        return 1
+    return shape[0] * shape[1] / (img.shape[0] * img.shape[1])
+
+
+def scaled_shape(img, shape, sample):
+    # (h, w) of the full size output of a filter keeping the proportions of its input
+    if not isinstance(img, np.ndarray) or img.ndim < 2 or not isinstance(sample, np.ndarray):
+        return shape
+    return (round(img.shape[0] * shape[0] / max(1, sample.shape[0])),
+            round(img.shape[1] * shape[1] / max(1, sample.shape[1])))
+
+
+def sample_step(step, shape, sample_shape):
+    # a filter giving an image of a fixed size: the step with its size arguments reduced as the image
+    # and the (h, w) of its output for the full size input of this shape, None for the other filters
+    key = (getattr(step.func, '__module__', None), getattr(step.func, '__name__', None))
+    if key not in (('filters', 'resize'), ('filters', 'exact_crop')):
+        return None
+    args = lut.filter_args(step.func, step.args)
+    h, w = shape
+    height = int(args['height']) if args['height'] is not None else h
+    width = int(args['width']) if args['width'] is not None else w
+    ky, kx = sample_shape[0] / h, sample_shape[1] / w
+    sample_args = dict(args, height=max(1, round(height * ky)), width=max(1, round(width * kx)))
+    if key == ('filters', 'resize'):
+        return Step(step.name, step.func, sample_args, step.inputs, step.outputs, 1, 1), (height, width)
+    x, y = int(args['x']), int(args['y'])
+    sample_args.update(x=min(round(x * kx), sample_shape[1] - 1), y=min(round(y * ky), sample_shape[0] - 1))
+    out_shape = (max(0, min(h, y + height) - y), max(0, min(w, x + width) - x))
+    return Step(step.name, step.func, sample_args, step.inputs, step.outputs, 1, 1), out_shape
+
+
+def plan_release(steps, result_slots):
+    # slots to release after every step: the step is the last consumer of the slot in the execution order,
+    # or the step produces the slot and nothing consumes it
+    last_use = dict()
+    for i, step in enumerate(steps):
+        for slot in step.outputs:
+            last_use[slot] = i
+        for slot in step.inputs:
+            last_use[slot] = i
+    for slot in result_slots:
+        last_use[slot] = len(steps)
+
+    release = [[] for _ in steps]
+    for slot, i in last_use.items():
+        if i < len(steps):
+            release[i].append(slot)
+    return release
+
+
+def step_key(step):
+    if isinstance(step, LutStep):
+        return tuple(step_key(sub_step) for sub_step in step.steps)
+    return step.name, tuple(sorted(step.args.items()))
+
+
+def img_key(img):
+    # content hash, so the same image read again gets the same key
+    digest = hashlib.blake2b(repr((img.shape, img.dtype.str)).encode(), digest_size=16)
+    digest.update(np.ascontiguousarray(img).data)
+    return digest.hexdigest()
+
+
+def result_key(step, input_keys):
+    return hashlib.blake2b(repr((step_key(step), input_keys)).encode(), digest_size=16).hexdigest()
+
+
+class ResultCache:
+    # step results by result_key, least recently used ones are dropped above max_bytes.
+    # Stored images are made read-only, they are shared by every plan run that hits them.
+    def __init__(self, max_bytes=512 * 1024**2):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, imgs):
+        n_bytes = sum(img.nbytes for img in imgs)
+        if n_bytes > self.max_bytes:
+            return
+        for img in imgs:
+            img.flags.writeable = False
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (imgs, n_bytes)
+            self.n_bytes += n_bytes
+            while self.n_bytes > self.max_bytes:
+                _, (_, old_bytes) = self.entries.popitem(last=False)
+                self.n_bytes -= old_bytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+
+def freeze_args(node):
+    args = dict()
+    for arg, value in node.args.items():
+        try:
+            args[arg] = float(value)
+        except ValueError:
+            raise GraphError(f"Incorrect value of argument {arg} in {node.name}")
+    return args
+
+
+def fuse_pointwise_steps(steps, result_slots):
+    consumers = Counter(result_slots)
+    for step in steps:
+        consumers.update(step.inputs)
+
+    fused = []
+    producers = dict()
+    for step in steps:
+        prev = producers.get(step.inputs[0]) if step.n_in == 1 else None
+        if (prev is not None and consumers[step.inputs[0]] == 1 and lut.is_lut_filter(step.func)
+                and (isinstance(prev, LutStep) or lut.is_lut_filter(prev.func))):
+            if isinstance(prev, LutStep):
+                chain, table = prev.steps, prev.table
+            else:
+                chain, table = [prev], lut.filter_lut(prev.func, prev.args)
+            new_step = LutStep(chain + [step], lut.compose(table, lut.filter_lut(step.func, step.args)))
+            fused[fused.index(prev)] = new_step
+            step = new_step
+        else:
+            fused.append(step)
+        for slot in step.outputs:
+            producers[slot] = step
+    return fused
+
+
+def topological_order(nodes, edges):
+    # edges from or to nodes outside of the given ones are ignored
+    in_degree = {node: 0 for node in nodes}
+    children = {node: [] for node in nodes}
+    for src, _, dst, _ in edges:
+        if src in in_degree and dst in in_degree:
+            in_degree[dst] += 1
+            children[src].append(dst)
+
+    queue = deque(node for node in nodes if in_degree[node] == 0)
+    order = []
+    while queue:
+        node = queue.popleft()
+        order.append(node)
+        for child in children[node]:
+            in_degree[child] -= 1
+            if in_degree[child] == 0:
+                queue.append(child)
+    if len(order) != len(nodes):
+        raise GraphError("The graph contains a cycle")
+    return order
+
+
+def compile_plan(nodes, edges, target=None):
+    # edges: (src node, src port, dst node, dst port)
+    parents = {node: [None] * node.n_in for node in nodes}
+    for src, src_port, dst, dst_port in edges:
+        if parents[dst][dst_port] is not None:
+            raise GraphError(f"Input {dst_port} of {dst.name} has several connections")
+        parents[dst][dst_port] = (src, src_port)
+
+    targets = [target] if target is not None else [node for node in nodes if node.n_out == 0]
+    if not targets:
+        raise GraphError("The graph has no output nodes")
+
+    needed = set()
+    stack = list(targets)
+    while stack:
+        node = stack.pop()
+        if node in needed:
+            continue
+        needed.add(node)
+        for port, parent in enumerate(parents[node]):
+            if parent is None:
+                raise GraphError(f"Input {port} of {node.name} is not connected")
+            stack.append(parent[0])
+
+    order = topological_order([node for node in nodes if node in needed], edges)
+
+    slots = dict()
+    for node in order:
+        for port in range(node.n_out):
+            slots[(node, port)] = len(slots)
+
+    steps = []
+    input_slots = []
+    for node in order:
+        if node.n_in == 0:
+            input_slots.extend(slots[(node, port)] for port in range(node.n_out))
+        elif node.n_out > 0:
+            steps.append(Step(node.name, node.func, freeze_args(node),
+                              [slots[parent] for parent in parents[node]],
+                              [slots[(node, port)] for port in range(node.n_out)],
+                              node.n_in, node.n_out))
+    if not input_slots:
+        raise GraphError("The graph has no input nodes")
+
+    result_slots = []
+    for node in targets:
+        if node.n_out == 0:
+            result_slots.append(slots[parents[node][0]])
+        else:
+            result_slots.extend(slots[(node, port)] for port in range(node.n_out))
+
+    return ExecutionPlan(steps, len(slots), input_slots, result_slots)
+
+
+def compile_chain(actions, depth=False):
+    # plan of MainWindow actions, every filter is followed by standart (keep_depth in the high bit depth mode)
+    # as in apply_filter
+    convert = keep_depth if depth else standart
+    steps = []
+    for i, (method, action_args) in enumerate(actions):
+        steps.append(Step(method.name, method.func, action_args, [2 * i], [2 * i + 1], 1, 1))
+        steps.append(Step(convert.__name__, convert, {}, [2 * i + 1], [2 * i + 2], 1, 1))
+    return ExecutionPlan(steps, 2 * len(actions) + 1, [0], [2 * len(actions)])
@@ -0,0 +1,132 @@
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from img_store import is_file_backed
+
+
+class ImgHistory:
+    # Every state keeps references to the images, an image shared by several states is stored once.
+    # Stored images are made read-only, so a filter can't change a state behind the history's back.
+    def __init__(self, max_bytes=2 * 1024**3, max_steps=30):
+        self.max_bytes = max_bytes
+        self.max_steps = max_steps
+
+        self.undo_states = []
+        self.redo_states = []
+
+        self.buffers = dict()
+        self.keys = dict()
+        self.refs = dict()
+        self.lru = OrderedDict()
+        self.mem_bytes = 0
+        self.next_key = 0
+        self.tmp_dir = None
+
+    @staticmethod
+    def in_ram(img):
+        # images of the image store are already on disk and are neither counted nor evicted
+        return isinstance(img, np.ndarray) and not is_file_backed(img)
+
+    def store(self, img):
+        key = self.keys.get(id(img))
+        if key is None or self.buffers[key] is not img:
+            key = self.next_key
+            self.next_key += 1
+            self.buffers[key] = img
+            self.keys[id(img)] = key
+            self.refs[key] = 0
+            if isinstance(img, np.ndarray):
+                img.flags.writeable = False
+                if self.in_ram(img):
+                    self.mem_bytes += img.nbytes
+        self.refs[key] += 1
+        if key in self.lru:
+            self.lru.move_to_end(key)
+        elif self.in_ram(self.buffers[key]):
+            self.lru[key] = None
+        return key
+
+    def load(self, key):
+        img = self.buffers[key]
+        if isinstance(img, Path):
+            path = img
+            img = np.load(path)
+            img.flags.writeable = False
+            path.unlink()
+            self.buffers[key] = img
+            self.keys[id(img)] = key
+            self.mem_bytes += img.nbytes
+            self.lru[key] = None
+        if key in self.lru:
+            self.lru.move_to_end(key)
+        return img
+
+    def release(self, key):
+        self.refs[key] -= 1
+        if self.refs[key] > 0:
+            return
+        img = self.buffers.pop(key)
+        del self.refs[key]
+        if isinstance(img, Path):
+            img.unlink()
+        else:
+            del self.keys[id(img)]
+            if key in self.lru:
+                del self.lru[key]
+                self.mem_bytes -= img.nbytes
+
+    def evict(self, keep):
+        # least recently used images go to disk until the history fits into max_bytes
+        for key in list(self.lru):
+            if self.mem_bytes <= self.max_bytes:
+                break
+            if key in keep:
+                continue
+            if self.tmp_dir is None:
+                self.tmp_dir = tempfile.TemporaryDirectory(prefix="img_history_")
+            img = self.buffers[key]
+            path = Path(self.tmp_dir.name) / f"{key}.npy"
+            np.save(path, img)
+            self.buffers[key] = path
+            del self.keys[id(img)]
+            del self.lru[key]
+            self.mem_bytes -= img.nbytes
+
+    def make_state(self, imgs_list, img_index, action_seq):
+        return [self.store(img) for img in imgs_list], img_index, list(action_seq)
+
+    def restore_state(self, state):
+        keys, img_index, action_seq = state
+        imgs_list = [self.load(key) for key in keys]
+        self.evict(set(keys))
+        for key in keys:
+            self.release(key)
+        return imgs_list, img_index, action_seq
+
+    def drop_states(self, states):
+        for keys, _, _ in states:
+            for key in keys:
+                self.release(key)
+        states.clear()
+
+    def push(self, imgs_list, img_index, action_seq):
+        self.drop_states(self.redo_states)
+        self.undo_states.append(self.make_state(imgs_list, img_index, action_seq))
+        if len(self.undo_states) > self.max_steps:
+            self.drop_states([self.undo_states.pop(0)])
+        self.evict(set())
+
+    def undo(self, imgs_list, img_index, action_seq):
+        if not self.undo_states:
+            return None
+        self.redo_states.append(self.make_state(imgs_list, img_index, action_seq))
+        return self.restore_state(self.undo_states.pop())
+
+    def redo(self, imgs_list, img_index, action_seq):
+        if not self.redo_states:
+            return None
+        self.undo_states.append(self.make_state(imgs_list, img_index, action_seq))
+        return self.restore_state(self.redo_states.pop())
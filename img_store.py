@@ -0,0 +1,83 @@
+import os
+import mmap
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+
+def is_file_backed(img):
+    base = img
+    while isinstance(base, np.ndarray) and not isinstance(base, np.memmap) and base.base is not None:
+        base = base.base
+    if isinstance(base, memoryview):
+        base = base.obj
+    return isinstance(base, (np.memmap, mmap.mmap))
+
+
+class ImgStore:
+    # Images are written once into a scratch directory and used as read-only views of mapped files.
+    # Only the working set of recently shown images is asked to stay in ram.
+    def __init__(self, working_set_bytes=1024**3):
+        self.working_set_bytes = working_set_bytes
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="img_store_")
+        self.maps = dict()
+        self.keys = dict()
+        self.working_set = OrderedDict()
+        self.working_bytes = 0
+        self.next_key = 0
+        self.lock = threading.Lock()
+
+    def put(self, img):
+        if img is None or img.nbytes == 0 or id(img) in self.keys:
+            return img
+        with self.lock:
+            key = self.next_key
+            self.next_key += 1
+
+        path = Path(self.tmp_dir.name) / f"{key}.raw"
+        with open(path, 'w+b') as f:
+            np.ascontiguousarray(img).tofile(f)
+            f.flush()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # the data stays reachable through the mapping, the disk space is freed with the last view
+            os.unlink(path)
+        except OSError:
+            pass
+
+        view = np.frombuffer(mapped, dtype=img.dtype).reshape(img.shape)
+        with self.lock:
+            self.maps[key] = mapped
+            self.keys[id(view)] = key
+        weakref.finalize(view, self.forget, key, id(view))
+        return view
+
+    def forget(self, key, view_id):
+        with self.lock:
+            self.maps.pop(key, None)
+            self.keys.pop(view_id, None)
+            if key in self.working_set:
+                self.working_bytes -= self.working_set.pop(key)
+
+    def touch(self, img):
+        with self.lock:
+            key = self.keys.get(id(img))
+            if key is None:
+                return
+            if key in self.working_set:
+                self.working_set.move_to_end(key)
+            else:
+                self.working_set[key] = img.nbytes
+                self.working_bytes += img.nbytes
+
+            while self.working_bytes > self.working_set_bytes and len(self.working_set) > 1:
+                old_key, nbytes = self.working_set.popitem(last=False)
+                self.working_bytes -= nbytes
+                mapped = self.maps.get(old_key)
+                if mapped is not None and hasattr(mmap, 'MADV_DONTNEED'):
+                    # pages are read again from the file on the next access
+                    mapped.madvise(mmap.MADV_DONTNEED)
@@ -2,11 +2,13 @@ import sys
 
 from PyQt5.QtWidgets import QWidget, QHBoxLayout, QLabel, QApplication, QFileDialog, QMainWindow, QAction, \
     QVBoxLayout, QPushButton, QGridLayout, QLineEdit, QTextEdit, QScrollArea
-from PyQt5.QtGui import QPixmap, QImage, QIcon, QFont, QCursor
-from PyQt5.QtCore import pyqtSignal, pyqtSlot, QEvent, QObject, QPoint, QTimer, Qt
+from PyQt5.QtGui import QPixmap, QImage, QIcon, QFont, QCursor, QPainter, QPen, QGuiApplication
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QEvent, QObject, QPoint, QRect, QTimer, Qt
 import numpy as np
 import cv2
 
+from preview import PyramidCache, to_rgb
+
 
 class MouseTracker(QObject):
     positionChanged = pyqtSignal(QPoint)
@@ -19,23 +21,91 @@ class MouseTracker(QObject):
         self.widget.setMouseTracking(True)
         self.widget.installEventFilter(self)
 
+        # moves are coalesced, only the last position of a display frame is emitted
+        self.move_pos = None
+        self.move_timer = QTimer(self)
+        self.move_timer.setSingleShot(True)
+        screen = QGuiApplication.primaryScreen()
+        refresh_rate = screen.refreshRate() if screen is not None and screen.refreshRate() > 0 else 60
+        self.move_timer.setInterval(int(1000 / refresh_rate))
+        self.move_timer.timeout.connect(self.emit_move)
+
     @property
     def widget(self):
         return self._widget
 
+    def emit_move(self):
+        self.move_timer.stop()
+        if self.move_pos is not None:
+            pos, self.move_pos = self.move_pos, None
+            self.positionChanged.emit(pos)
+
     def eventFilter(self, obj, event):
         if obj is self.widget and event.type() == QEvent.MouseMove:
-            self.positionChanged.emit(event.pos())
+            self.move_pos = event.pos()
+            if not self.move_timer.isActive():
+                self.move_timer.start()
 
         if obj is self.widget and event.type() == QEvent.MouseButtonPress:
+            self.emit_move()
             self.buttonPressed.emit(event.pos())
 
         if obj is self.widget and event.type() == QEvent.MouseButtonRelease:
+            self.emit_move()
             self.buttonReleased.emit(event.pos())
 
         return super().eventFilter(obj, event)
 
 
+class ImgCanvas(QWidget):
+    # has the size of the zoomed image, but only the part shown in the viewport is resized and converted.
+    # The converted part is kept as a pixmap, the crop rectangle is painted over it.
+    def __init__(self, img_window):
+        super().__init__(img_window)
+        self.img_window = img_window
+        self.base = None
+        self.base_rect = QRect()
+
+    def invalidate(self):
+        self.base = None
+        self.base_rect = QRect()
+        self.update()
+
+    def visible_rect(self):
+        viewport = self.img_window.viewport()
+        return QRect(-self.x(), -self.y(), viewport.width(), viewport.height())
+
+    def make_base(self):
+        window = self.img_window
+        self.base_rect = self.visible_rect().intersected(QRect(0, 0, window.shape[1], window.shape[0]))
+        x, y, w, h = self.base_rect.x(), self.base_rect.y(), self.base_rect.width(), self.base_rect.height()
+        frame = to_rgb(window.pyramid.region(window.img, window.scale, x, y, w, h))
+        img = QImage(frame, frame.shape[1], frame.shape[0], frame.strides[0], QImage.Format_RGB888)
+        self.base = QPixmap.fromImage(img)
+
+    def paintEvent(self, event):
+        window = self.img_window
+        if window.img is None:
+            return
+        rect = event.rect().intersected(QRect(0, 0, window.shape[1], window.shape[0])).intersected(self.visible_rect())
+        if rect.isEmpty():
+            return
+        if self.base is None or not self.base_rect.contains(rect):
+            self.make_base()
+
+        painter = QPainter(self)
+        painter.drawPixmap(rect, self.base, rect.translated(-self.base_rect.topLeft()))
+        if window.preview is not None:
+            preview_rect, preview = window.preview
+            painter.setClipRect(rect)
+            painter.drawPixmap(preview_rect.topLeft(), preview)
+            painter.setClipping(False)
+        if window.rect_points is not None:
+            painter.setPen(QPen(Qt.white, 2))
+            painter.drawRect(window.points_rect(window.rect_points))
+        painter.end()
+
+
 class ImageWindow(QScrollArea):
 
     def __init__(self, parent=None):
@@ -44,48 +114,77 @@ class ImageWindow(QScrollArea):
         self.parent = parent
 
         self.img = None
+        self.scale = 1
+        self.shape = None
+        self.pyramids = PyramidCache()
+        self.pyramid = None
         self.mouse_pos = None
 
         self.tmp_rect_points = None
         self.rect = None
+        self.rect_points = None
+        self.preview = None
 
         self.rect_border = False
         self.rect_transform_border = None
         #self.rect_transform = False
 
-        self.setWidgetResizable(True)
-        self.img_label = QLabel(self)
-        self.img_label.setStyleSheet("background-color: rgba(110, 110, 110, 255);")
+        self.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
+        self.viewport().setStyleSheet("background-color: rgba(110, 110, 110, 255);")
+        self.img_canvas = ImgCanvas(self)
 
         self.img_info = QLabel(self)
         self.img_info.setStyleSheet("background-color: rgba(224, 224, 224, 90);")
         self.img_info.setFont(QFont('Arial', 16))
 
-        # self.img_label.setScaledContents(True)
-        self.setWidget(self.img_label)
-        self.img_pixmap = None
+        self.setWidget(self.img_canvas)
 
         self.setMouseTracking(True)
 
-        self.mouse_tracker = MouseTracker(self.img_label)
+        self.mouse_tracker = MouseTracker(self.img_canvas)
         self.mouse_tracker.buttonPressed.connect(self.mouse_press)
         self.mouse_tracker.buttonReleased.connect(self.mouse_release)
         self.mouse_tracker.positionChanged.connect(self.mouse_move)
 
-    def set_img(self, img):
+    def set_img(self, img, scale=1):
         self.img = img
-        self.update_img(self.img)
-
-    def update_img(self, img):
-        frame = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img = QImage(frame, frame.shape[1], frame.shape[0], frame.strides[0], QImage.Format_RGB888)
-
-        self.img_pixmap = QPixmap.fromImage(img)
-        self.img_label.setPixmap(self.img_pixmap)
+        self.scale = scale
+        self.pyramid = self.pyramids.get(img)
+        self.shape = (int(img.shape[0] * scale), int(img.shape[1] * scale))
+        self.rect_points = None
+        self.preview = None
+        self.img_canvas.resize(self.shape[1], self.shape[0])
+        self.img_canvas.invalidate()
+
+    def visible_img(self):
+        # shown part of the image at the shown scale and its place on the canvas
+        rect = self.img_canvas.visible_rect().intersected(QRect(0, 0, self.shape[1], self.shape[0]))
+        if rect.isEmpty():
+            return None, rect
+        return self.pyramid.region(self.img, self.scale, rect.x(), rect.y(), rect.width(), rect.height()), rect
+
+    def set_preview(self, img, rect):
+        frame = to_rgb(img)
+        preview = QPixmap.fromImage(QImage(frame, frame.shape[1], frame.shape[0], frame.strides[0],
+                                           QImage.Format_RGB888))
+        self.clear_preview()
+        self.preview = (rect, preview)
+        self.img_canvas.update(QRect(rect.topLeft(), preview.size()))
+
+    def clear_preview(self):
+        if self.preview is not None:
+            rect, preview = self.preview
+            self.preview = None
+            self.img_canvas.update(QRect(rect.topLeft(), preview.size()))
+
+    def img_pixel(self, pos):
+        x = min(int(pos[0] / self.scale), self.img.shape[1] - 1)
+        y = min(int(pos[1] / self.scale), self.img.shape[0] - 1)
+        return self.img[y, x]
 
     def convert_mouse_pos(self, pos):
         if self.img is not None:
-            img_shift = (self.img_label.size().height() - self.img.shape[0]) // 2
+            img_shift = (self.img_canvas.size().height() - self.shape[0]) // 2
             pos[1] -= img_shift
         return pos
 
@@ -98,11 +197,11 @@ class ImageWindow(QScrollArea):
     @pyqtSlot(QPoint)
     def mouse_move(self, pos):
         self.mouse_pos = self.convert_mouse_pos([pos.x(), pos.y()])
-        if self.img is not None and all((0 <= self.mouse_pos[i] < self.img.shape[1-i]) for i in range(2)):
+        if self.img is not None and all((0 <= self.mouse_pos[i] < self.shape[1-i]) for i in range(2)):
             if len(self.img.shape) == 3:
-                pixel_color = dict(zip(['B', 'G', 'R'], self.img[self.mouse_pos[1], self.mouse_pos[0], :]))
+                pixel_color = dict(zip(['B', 'G', 'R'], self.img_pixel(self.mouse_pos)))
             elif len(self.img.shape) == 2:
-                pixel_color = {"B": self.img[self.mouse_pos[1], self.mouse_pos[0]]}
+                pixel_color = {"B": self.img_pixel(self.mouse_pos)}
             else:
                 pixel_color = ""
             self.img_info.setText(f"{dict(zip(['X', 'Y'], self.mouse_pos))}\n"
@@ -122,7 +221,7 @@ class ImageWindow(QScrollArea):
     def draw_rectangle(self, stage):
         if not self.rect_border and self.rect_transform_border is None:
             if stage == 1:
-                if 0 <= self.mouse_pos[0] < self.img.shape[1] and 0 <= self.mouse_pos[1] < self.img.shape[0]:
+                if 0 <= self.mouse_pos[0] < self.shape[1] and 0 <= self.mouse_pos[1] < self.shape[0]:
                     self.tmp_rect_points = [self.mouse_pos]
             elif stage == 2:
                 if self.tmp_rect_points is not None:
@@ -139,10 +238,19 @@ class ImageWindow(QScrollArea):
                     self.draw_rectangle_by_points(self.tmp_rect_points)
                 self.tmp_rect_points = None
 
+    @staticmethod
+    def points_rect(points):
+        (x0, y0), (x1, y1) = np.sort(points, axis=0)
+        return QRect(int(x0), int(y0), int(x1 - x0), int(y1 - y0))
+
     def draw_rectangle_by_points(self, points):
-        img_copy = self.img.copy()
-        cv2.rectangle(img_copy, points[0], points[1], (255, 255, 255), 2)
-        self.update_img(img_copy)
+        # only the old and the new rectangle borders are repainted
+        dirty = QRect()
+        if self.rect_points is not None:
+            dirty = self.points_rect(self.rect_points)
+        self.rect_points = np.array(points)
+        dirty = dirty.united(self.points_rect(self.rect_points)).adjusted(-2, -2, 2, 2)
+        self.img_canvas.update(dirty)
 
     def set_cursor(self):
         if self.rect is not None:
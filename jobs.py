@@ -0,0 +1,94 @@
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobSignals(QObject):
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(object)
+    error = pyqtSignal(object)
+    stopped = pyqtSignal()
+
+
+class Job(QRunnable):
+    # func gets the job as the first argument and calls job.check(done, total) between steps
+    def __init__(self, func, *args, **kwargs):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = JobSignals()
+        self.cancelled = False
+
+    def check(self, done, total):
+        if self.cancelled:
+            raise JobCancelled()
+        self.signals.progress.emit(done, total)
+
+    def run(self):
+        try:
+            result = self.func(self, *self.args, **self.kwargs)
+            if not self.cancelled:
+                self.signals.finished.emit(result)
+        except JobCancelled:
+            pass
+        except Exception as e:
+            if not self.cancelled:
+                self.signals.error.emit(e)
+        finally:
+            self.signals.stopped.emit()
+
+
+class JobManager(QObject):
+    # results come back through queued signals, so the callbacks run in the gui thread
+    running_changed = pyqtSignal(bool)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool.globalInstance()
+        self.jobs = dict()
+        # cancelled jobs may still be running, the python objects have to live until they stop
+        self.alive = set()
+
+    def start(self, key, func, *args, on_finished=None, on_progress=None, on_error=None, **kwargs):
+        # a new request with the same key replaces the previous one
+        self.cancel(key)
+        job = Job(func, *args, **kwargs)
+        job.signals.finished.connect(lambda result: self.job_done(key, job, on_finished, result))
+        job.signals.error.connect(lambda error: self.job_done(key, job, on_error, error))
+        job.signals.stopped.connect(lambda: self.alive.discard(job))
+        if on_progress is not None:
+            job.signals.progress.connect(on_progress)
+        self.jobs[key] = job
+        self.alive.add(job)
+        self.pool.start(job)
+        self.running_changed.emit(True)
+        return job
+
+    def job_done(self, key, job, callback, value):
+        if self.jobs.get(key) is not job:
+            return
+        del self.jobs[key]
+        if not self.jobs:
+            self.running_changed.emit(False)
+        if callback is not None:
+            callback(value)
+
+    def cancel(self, key):
+        job = self.jobs.pop(key, None)
+        if job is not None:
+            job.cancelled = True
+            if self.pool.tryTake(job):
+                self.alive.discard(job)
+            if not self.jobs:
+                self.running_changed.emit(False)
+
+    def cancel_all(self):
+        for key in list(self.jobs):
+            self.cancel(key)
+
+    def is_running(self, key=None):
+        return key in self.jobs if key is not None else bool(self.jobs)
@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from graph_executor import compile_chain
+
+
+class PendingImg:
+    def __init__(self, base, actions, depth=False):
+        self.base = base
+        self.actions = actions
+        self.depth = depth
+
+    def compute(self):
+        return compile_chain(self.actions, self.depth).run(self.base)[0]
+
+
+def computed(img):
+    return img.compute() if isinstance(img, PendingImg) else img
+
+
+class LazyRunner:
+    def __init__(self, workers=2):
+        self.executor = ThreadPoolExecutor(workers)
+        self.futures = dict()
+
+    @staticmethod
+    def defer(img, method, action_args, depth=False):
+        if isinstance(img, PendingImg):
+            return PendingImg(img.base, img.actions + [(method, action_args)], img.depth)
+        return PendingImg(img, [(method, action_args)], depth)
+
+    def materialize(self, img):
+        if not isinstance(img, PendingImg):
+            return img
+        future = self.futures.pop(img, None)
+        if future is None or future.cancelled():
+            return img.compute()
+        return future.result()
+
+    def prefetch(self, imgs):
+        # opencv releases the GIL, so neighbours are computed while the user looks at the current image
+        imgs = [img for img in imgs if isinstance(img, PendingImg)]
+        for img in list(self.futures):
+            if img not in imgs:
+                self.futures.pop(img).cancel()
+        for img in imgs:
+            if img not in self.futures:
+                self.futures[img] = self.executor.submit(img.compute)
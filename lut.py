@@ -0,0 +1,136 @@
+from functools import lru_cache
+from inspect import signature, Parameter
+
+import cv2
+import numpy as np
+
+from suppotr_functions import keep_depth
+
+
+def frozen(table):
+    table.flags.writeable = False
+    return table
+
+
+# curves of the pointwise filters on levels given in 0..255, whatever the bit depth of the image
+
+def gamma_curve(levels, gamma):
+    c = 255
+    return c * ((levels / 255.0) ** gamma)
+
+
+def linear_curve(levels, k, b):
+    return k * levels + b
+
+
+def piecewise_linear_3_curve(levels, x1, y1, x2, y2):
+    # divisions of numpy floats, a degenerate segment (x1 = 0 or x1 = x2) gives inf or nan
+    # only in a branch that is never selected instead of raising ZeroDivisionError
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(levels < x1 * 255, levels * np.divide(y1, x1),
+                        np.where(levels < x2 * 255, (levels - 255 * x1) * (y2 - y1) / (x2 - x1) + y1 * 255,
+                                 (levels - 255) * (y2 - 1) * (x2 - 1) + 255))
+
+
+def threshold_curve(levels, threshold):
+    return np.where(levels > threshold, 255, 0)
+
+
+def not_curve(levels):
+    return 255 - levels
+
+
+def identity_curve(levels):
+    return levels
+
+
+@lru_cache(maxsize=128)
+def curve_table(curve, args, maxval=255):
+    # table of an uint8 (maxval 255) or uint16 (maxval 65535) image,
+    # 16 bit tables are rounded, 8 bit tables truncate as the filters always did
+    levels = np.arange(maxval + 1, dtype=np.float64)
+    if maxval != 255:
+        levels = levels * 255 / maxval
+    table = np.clip(curve(levels, *args), 0, 255)
+    if maxval != 255:
+        table = np.rint(table * (maxval / 255))
+    return frozen(table.astype(np.uint8 if maxval == 255 else np.uint16))
+
+
+def apply(img, curve, *args, dst=None):
+    # uint8 and uint16 images go through the table of the curve, float images in 0..1 through the curve itself,
+    # other integer images (like int16 of laplasiian) are cut to uint8 first, as standart does after a filter
+    if img.dtype.kind in 'biu' and img.dtype not in (np.uint8, np.uint16):
+        return apply(keep_depth(img), curve, *args)
+    if img.dtype == np.uint8:
+        return cv2.LUT(img, curve_table(curve, args), dst=dst)
+    if img.dtype == np.uint16:
+        return np.take(curve_table(curve, args, 65535), img, out=dst)
+    res = np.clip(curve(img * 255.0, *args), 0, 255)
+    res = res / 255.0
+    if dst is None:
+        return res.astype(img.dtype, copy=False)
+    np.copyto(dst, res, casting='unsafe')
+    return dst
+
+
+def gamma_lut(gamma, maxval=255):
+    return curve_table(gamma_curve, (gamma,), maxval)
+
+
+def linear_lut(k, b, maxval=255):
+    return curve_table(linear_curve, (k, b), maxval)
+
+
+def piecewise_linear_3_lut(x1, y1, x2, y2, maxval=255):
+    return curve_table(piecewise_linear_3_curve, (x1, y1, x2, y2), maxval)
+
+
+def threshold_lut(threshold, maxval=255):
+    return curve_table(threshold_curve, (threshold,), maxval)
+
+
+def not_lut(maxval=255):
+    return curve_table(not_curve, (), maxval)
+
+
+def identity_lut(maxval=255):
+    # standart doesn't change an uint8 image
+    return curve_table(identity_curve, (), maxval)
+
+
+def compose(first, second):
+    # table of applying first and then second
+    return frozen(second[first])
+
+
+# pointwise filters (module, name) -> function building their table for an uint8 (or uint16) image
+# from the filter arguments
+LUT_FILTERS = {
+    ('filters', 'gamma_correction'): gamma_lut,
+    ('filters', 'linear_hist_transform'): linear_lut,
+    ('filters', 'piecewise_linear_3_transform'): piecewise_linear_3_lut,
+    ('filters', 'thresholding'): threshold_lut,
+    ('special_filters_for_scene', 'bitwise_not'): not_lut,
+    ('suppotr_functions', 'standart'): identity_lut,
+    ('suppotr_functions', 'keep_depth'): identity_lut,
+}
+
+
+def is_lut_filter(func):
+    return (getattr(func, '__module__', None), getattr(func, '__name__', None)) in LUT_FILTERS
+
+
+def filter_args(func, args):
+    # values of the filter arguments with the defaults, without the image and keyword-only arguments like dst
+    sig = signature(func)
+    bound = sig.bind(None, **args)
+    bound.apply_defaults()
+    params = {name: value for name, value in bound.arguments.items()
+              if sig.parameters[name].kind == Parameter.POSITIONAL_OR_KEYWORD}
+    params.pop(next(iter(params)))
+    return params
+
+
+def filter_lut(func, args, maxval=255):
+    return LUT_FILTERS[(func.__module__, func.__name__)](**filter_args(func, args), maxval=maxval)
@@ -1,17 +1,24 @@
 import sys
 import os
+import multiprocessing
 from functools import partial
 from pathlib import Path
 
 from PyQt5.QtWidgets import QWidget, QHBoxLayout, QLabel, QApplication, QFileDialog, QMainWindow, QAction, \
-    QVBoxLayout, QPushButton, QGridLayout, QLineEdit, QTextEdit, QScrollArea
+    QVBoxLayout, QPushButton, QGridLayout, QLineEdit, QTextEdit, QScrollArea, QProgressBar
 from PyQt5.QtGui import QPixmap, QImage, QIcon, QFont
 from PyQt5.QtCore import pyqtSignal, pyqtSlot, QEvent, QObject, QPoint, QTimer, Qt
 import numpy as np
-from suppotr_functions import standart
+from suppotr_functions import standart, keep_depth
 import cv2
 
 import func2action
+import batch_filters
+import filter_script
+from img_history import ImgHistory
+from img_store import ImgStore
+from lazy_imgs import LazyRunner, computed
+from jobs import JobManager
 from derivative_windows import *
 from img_window import ImageWindow
 from filter_constructor_window import ConstructorWindow
@@ -21,13 +28,6 @@ FONT_SIZE = 16
 
 class MainWindow(QMainWindow):
 
-    @staticmethod
-    def resize_img(img, scale):
-        width = int(img.shape[1] * scale)
-        height = int(img.shape[0] * scale)
-        dim = (width, height)
-        return cv2.resize(img, dim, interpolation=cv2.INTER_AREA)
-
     def __init__(self):
 
         self.parent = super().__init__()
@@ -38,7 +38,17 @@ class MainWindow(QMainWindow):
         self.prev_img_filter = None
         self.img = None
         self.scale = 1
-        self.prev_imgs_list = None
+        self.store = ImgStore()
+        self.history = ImgHistory()
+        self.lazy = LazyRunner()
+        self.lazy_mode = False
+        self.stacked_mode = False
+        self.high_depth = False
+        self.jobs = JobManager(self)
+        # filters applied while another one is running, each is applied to the result of the previous one
+        self.filter_queue = []
+        self.progress_bar = None
+        self.stop_button = None
         self.imgs_list = []
         self.img_index = None
 
@@ -123,6 +133,10 @@ class MainWindow(QMainWindow):
         show_action_seq.setStatusTip('Show the filters sequence')
         show_action_seq.triggered.connect(self.show_action_sequence)
 
+        save_action_seq = QAction(QIcon(str(icons_folder / "save.png")), '&Save filters sequence', self)
+        save_action_seq.setStatusTip('Save the filters sequence as a script')
+        save_action_seq.triggered.connect(self.save_action_sequence)
+
         add_filters_action = QAction(QIcon(str(icons_folder / "new_filters.png")), '&Add new filters from file', self)
         add_filters_action.setStatusTip('Add filters from file')
         add_filters_action.triggered.connect(self.get_new_filters)
@@ -159,6 +173,25 @@ class MainWindow(QMainWindow):
         cancel_filter.setStatusTip("Go back to the previous image state")
         cancel_filter.triggered.connect(self.cancel_filter)
 
+        lazy_mode_action = QAction("&Lazy filters", self)
+        lazy_mode_action.setCheckable(True)
+        lazy_mode_action.setStatusTip("Apply filters to an image of the list only when it is shown")
+        lazy_mode_action.toggled.connect(self.set_lazy_mode)
+
+        stacked_mode_action = QAction("&Stacked batch", self)
+        stacked_mode_action.setCheckable(True)
+        stacked_mode_action.setStatusTip("Apply filters to equal images of the list with one call for all of them")
+        stacked_mode_action.toggled.connect(self.set_stacked_mode)
+
+        high_depth_action = QAction("&High bit depth", self)
+        high_depth_action.setCheckable(True)
+        high_depth_action.setStatusTip("Open 16 bit and float images as they are and keep their type after filters")
+        high_depth_action.toggled.connect(self.set_high_depth)
+
+        redo_filter = QAction("&Redo filter", self)
+        redo_filter.setStatusTip("Apply the cancelled filter again")
+        redo_filter.triggered.connect(self.redo_filter)
+
         open_constructor_action = QAction(QIcon(str(icons_folder / "constructor.png")), "&Construct filter alg", self)
         open_constructor_action.setStatusTip("filter constructor")
         open_constructor_action.triggered.connect(self.open_filter_constructor_window)
@@ -167,6 +200,16 @@ class MainWindow(QMainWindow):
 
         self.statusBar()
 
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(200)
+        self.stop_button = QPushButton("Stop")
+        self.stop_button.setStatusTip("Stop applying the filter")
+        self.stop_button.clicked.connect(self.stop_jobs)
+        self.statusBar().addPermanentWidget(self.progress_bar)
+        self.statusBar().addPermanentWidget(self.stop_button)
+        self.set_jobs_widgets(False)
+        self.jobs.running_changed.connect(self.set_jobs_widgets)
+
         menubar = self.menuBar()
 
         fileMenu = menubar.addMenu('&File')
@@ -177,7 +220,12 @@ class MainWindow(QMainWindow):
         filtersMenu.addAction(open_constructor_action)
         filtersMenu.addAction(add_filters_action)
         filtersMenu.addAction(show_action_seq)
+        filtersMenu.addAction(save_action_seq)
         filtersMenu.addAction(cancel_filter)
+        filtersMenu.addAction(redo_filter)
+        filtersMenu.addAction(lazy_mode_action)
+        filtersMenu.addAction(stacked_mode_action)
+        filtersMenu.addAction(high_depth_action)
 
         img_seqMenu = menubar.addMenu('&Images')
         img_seqMenu.addAction(open_img_info_message_action)
@@ -212,7 +260,8 @@ class MainWindow(QMainWindow):
         self.show()
 
     def set_img_2_img_window(self):
-        self.img_window.set_img(self.resize_img(self.img, self.scale))
+        self.store.touch(self.img)
+        self.img_window.set_img(self.img, self.scale)
 
     def add_2_tool_bar(self, action, descr):
         tool = self.addToolBar(descr)
@@ -221,14 +270,32 @@ class MainWindow(QMainWindow):
     def update_img_list(self):
         self.imgs_list[self.img_index] = self.img
 
+    def list_img(self, index):
+        self.imgs_list[index] = self.store.put(self.lazy.materialize(self.imgs_list[index]))
+        return self.imgs_list[index]
+
+    def show_list_img(self):
+        # a pending image of the lazy mode can fail when it is computed, the shown image stays then
+        try:
+            self.img = self.list_img(self.img_index)
+        except Exception as e:
+            self.show_job_error(e)
+            return False
+        self.set_img_2_img_window()
+        if self.lazy_mode:
+            n = len(self.imgs_list)
+            self.lazy.prefetch([self.imgs_list[(self.img_index + i) % n] for i in (1, -1)])
+        return True
+
     def get_img(self):
         filename = QFileDialog.getOpenFileName()[0]
         #filename = "/home/pashnya/Pictures/Wallpapers/initial-d.jpeg" #для отладки!!!
         #if filename is not None and filename != "":
         if filename != "":
-            self.img = cv2.imread(filename)
+            self.img = self.store.put(cv2.imread(filename, self.read_flags()))
             self.imgs_list.append(self.img)
             self.img_index = len(self.imgs_list) - 1
+            self.store.touch(self.img)
             self.img_window.set_img(self.img)
 
     def zoom_in_img(self):
@@ -240,7 +307,7 @@ class MainWindow(QMainWindow):
         self.set_img_2_img_window()
 
     def flip_img(self):
-        self.img = cv2.rotate(self.img, cv2.ROTATE_90_CLOCKWISE)
+        self.img = self.store.put(cv2.rotate(self.img, cv2.ROTATE_90_CLOCKWISE))
         self.update_img_list()
         self.set_img_2_img_window()
 
@@ -252,7 +319,7 @@ class MainWindow(QMainWindow):
 
     def add_new_image_2list(self):
         filename = QFileDialog.getOpenFileName()[0]
-        self.img = cv2.imread(filename)
+        self.img = self.store.put(cv2.imread(filename, self.read_flags()))
         self.imgs_list.append(self.img)
         self.img_index = len(self.imgs_list) - 1
         self.scale = 1
@@ -268,8 +335,8 @@ class MainWindow(QMainWindow):
                        crop_area[0, 0]:crop_area[1, 0]].copy()            
             self.update_img_list()'''
             crop_area = np.int64(crop_area / self.scale)
-            self.imgs_list.append(self.img[crop_area[0, 1]:crop_area[1, 1],
-                       crop_area[0, 0]:crop_area[1, 0]].copy())
+            self.imgs_list.append(self.store.put(self.img[crop_area[0, 1]:crop_area[1, 1],
+                                                          crop_area[0, 0]:crop_area[1, 0]]))
             self.img_index += 1
             #self.scale = 1
             self.img = self.imgs_list[self.img_index]
@@ -312,18 +379,17 @@ class MainWindow(QMainWindow):
         self.img_info_window.show()
 
     def next_img(self):
-        self.img_index += 1
-        self.scale = 1
-        self.img = self.imgs_list[self.img_index % len(self.imgs_list)]
-        self.img_index %= len(self.imgs_list)
-        self.set_img_2_img_window()
+        self.go_to_img(self.img_index + 1)
 
     def prev_img(self):
-        self.img_index -= 1
+        self.go_to_img(self.img_index - 1)
+
+    def go_to_img(self, index):
+        old_index, old_scale = self.img_index, self.scale
+        self.img_index = index % len(self.imgs_list)
         self.scale = 1
-        self.img = self.imgs_list[self.img_index % len(self.imgs_list)]
-        self.img_index %= len(self.imgs_list)
-        self.set_img_2_img_window()
+        if not self.show_list_img():
+            self.img_index, self.scale = old_index, old_scale
 
     def open_info_img_seq(self):
         self.imgs_seq_info_window = ImgsSeqInfoWindow(self.imgs_list, self.img_index)
@@ -335,29 +401,130 @@ class MainWindow(QMainWindow):
 
     def open_filter_constructor_window(self):
         self.constructor_window = ConstructorWindow(self.action_seq)
+        self.constructor_window.high_depth = self.high_depth
         self.constructor_window.show()
 
     def apply_filter(self, method, action_args):
+        if self.jobs.is_running("filter"):
+            self.filter_queue.append((method, action_args))
+            self.statusBar().showMessage(f"{method.name} will be applied after the running filter")
+            return
+        if self.lazy_mode:
+            imgs = [self.lazy.defer(img, method, action_args, self.high_depth) for img in self.imgs_list]
+            # the shown image is computed before the state changes, a failing filter leaves it as it was
+            try:
+                imgs[self.img_index] = self.store.put(self.lazy.materialize(imgs[self.img_index]))
+            except Exception as e:
+                self.show_job_error(e)
+                return
+            self.history.push(self.imgs_list, self.img_index, self.action_seq)
+            self.action_seq.append((method, action_args))
+            self.imgs_list = imgs
+            self.show_list_img()
+        else:
+            imgs = list(self.imgs_list)
+            self.statusBar().showMessage(f"Applying {method.name}")
+            self.jobs.start("filter", self.filter_imgs, self.store, imgs, method, action_args, self.stacked_mode,
+                            self.convert_result(),
+                            on_finished=partial(self.finish_filter, imgs, method, action_args),
+                            on_progress=self.show_progress, on_error=self.filter_error)
+
+    @staticmethod
+    def filter_imgs(job, store, imgs, method, action_args, stacked=False, convert=standart):
+        if stacked and len(imgs) > 1 and batch_filters.is_stack_filter(method.func):
+            stack = batch_filters.stack_imgs([computed(img) for img in imgs])
+            if stack is not None:
+                job.check(0, len(imgs))
+                res_stack = convert(batch_filters.apply_stacked(method.func, stack, action_args))
+                res = []
+                for i, res_img in enumerate(res_stack):
+                    job.check(i, len(imgs))
+                    res.append(store.put(res_img))
+                return res
+
+        res = []
+        for i, img in enumerate(imgs):
+            job.check(i, len(imgs))
+            res.append(store.put(convert(method.func(computed(img), **action_args))))
+        return res
+
+    def finish_filter(self, imgs, method, action_args, res_imgs):
+        if len(imgs) != len(self.imgs_list) or any(a is not b for a, b in zip(imgs, self.imgs_list)):
+            self.filter_queue.clear()
+            self.statusBar().showMessage(f"The images list was changed, {method.name} was not applied")
+            return
+        self.history.push(self.imgs_list, self.img_index, self.action_seq)
         self.action_seq.append((method, action_args))
-        self.prev_imgs_list = [image.copy() for image in self.imgs_list]
-        self.imgs_list = [standart(method.func(img, **action_args)) for img in self.imgs_list]
-        self.img = self.imgs_list[self.img_index]
-        self.set_img_2_img_window()
+        self.imgs_list = res_imgs
+        self.show_list_img()
+        self.statusBar().showMessage(f"{method.name} applied")
+        if self.filter_queue:
+            self.apply_filter(*self.filter_queue.pop(0))
+
+    def filter_error(self, error):
+        # the queued filters were meant for the result of the failed one
+        self.filter_queue.clear()
+        self.show_job_error(error)
+
+    def show_progress(self, done, total):
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+
+    def show_job_error(self, error):
+        self.statusBar().showMessage(f"Error: {error}")
+
+    def set_jobs_widgets(self, running):
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(running)
+        self.stop_button.setVisible(running)
+
+    def stop_jobs(self):
+        self.filter_queue.clear()
+        self.jobs.cancel_all()
+        self.statusBar().showMessage("Stopped")
+
+    def set_lazy_mode(self, flag):
+        self.lazy_mode = flag
+
+    def set_stacked_mode(self, flag):
+        self.stacked_mode = flag
+
+    def set_high_depth(self, flag):
+        self.high_depth = flag
+        if self.constructor_window is not None:
+            self.constructor_window.high_depth = flag
+
+    def read_flags(self):
+        return cv2.IMREAD_UNCHANGED if self.high_depth else cv2.IMREAD_COLOR
+
+    def convert_result(self):
+        # every filter result is converted to the type of the images of the mode
+        return keep_depth if self.high_depth else standart
 
     def show_action_sequence(self):
         self.arg_seq_window = ActionSeqWindow(((method.name, action_args) for (method, action_args) in self.action_seq))
         self.arg_seq_window.show()
 
+    def save_action_sequence(self):
+        filename = QFileDialog.getSaveFileName()[0]
+        if filename != "":
+            filter_script.write_action_seq(filename, self.action_seq, self.high_depth)
+            self.statusBar().showMessage("Filters sequence save")
+
+    def set_history_state(self, state):
+        if state is not None:
+            self.imgs_list, self.img_index, self.action_seq = state
+            self.show_list_img()
+
     def cancel_filter(self):
-        if self.prev_imgs_list is not None:
-            self.imgs_list = [image.copy() for image in self.prev_imgs_list]
-            self.img = self.imgs_list[self.img_index]
-            self.set_img_2_img_window()
-            self.prev_imgs_list = None
-            del self.action_seq[-1]
+        self.set_history_state(self.history.undo(self.imgs_list, self.img_index, self.action_seq))
+
+    def redo_filter(self):
+        self.set_history_state(self.history.redo(self.imgs_list, self.img_index, self.action_seq))
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     try:
         os.chdir(sys._MEIPASS)
     except Exception:
@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from math import ceil, floor
+import weakref
+
+import cv2
+import numpy as np
+
+from suppotr_functions import standart
+
+MIN_LEVEL_SIZE = 256
+
+
+def to_display(img):
+    # 8 bit image for the screen, uint16 and float32 (0..1) images are scaled, other types are cut as by standart
+    if img.dtype == np.uint16:
+        return cv2.convertScaleAbs(img, alpha=255 / 65535)
+    if img.dtype == np.float32:
+        return standart(img * 255)
+    return standart(img)
+
+
+def to_rgb(img):
+    img = to_display(img)
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+class PreviewPyramid:
+    # levels halve the image size and are built the first time a zoom needs them,
+    # the image itself isn't kept, so the pyramid doesn't hold it in memory
+    def __init__(self):
+        self.levels = []
+
+    def level(self, img, scale):
+        # the smallest level not smaller than the shown image, so a level is never enlarged more than needed
+        levels = [img] + self.levels
+        i = 0
+        while 2 ** -(i + 1) >= scale and min(levels[i].shape[:2]) // 2 >= MIN_LEVEL_SIZE:
+            if i + 1 == len(levels):
+                levels.append(cv2.resize(levels[i], (levels[i].shape[1] // 2, levels[i].shape[0] // 2),
+                                         interpolation=cv2.INTER_AREA))
+                self.levels.append(levels[-1])
+            i += 1
+        return levels[i], 2 ** -i
+
+    def region(self, img, scale, x, y, w, h):
+        # part (x, y, w, h) of the image resized by scale, only this part is resized
+        level, level_scale = self.level(img, scale)
+        k = level_scale / scale
+        x0, y0 = min(floor(x * k), level.shape[1] - 1), min(floor(y * k), level.shape[0] - 1)
+        x1 = min(level.shape[1], max(x0 + 1, ceil((x + w) * k)))
+        y1 = min(level.shape[0], max(y0 + 1, ceil((y + h) * k)))
+        interpolation = cv2.INTER_AREA if k > 1 else cv2.INTER_LINEAR
+        return cv2.resize(level[y0:y1, x0:x1], (w, h), interpolation=interpolation)
+
+
+class PyramidCache:
+    # pyramids of the recently shown images, a pyramid is dropped together with its image,
+    # so a filtered image (always a new array) gets a new pyramid
+    def __init__(self, size=8):
+        self.size = size
+        self.pyramids = OrderedDict()
+
+    def get(self, img):
+        key = id(img)
+        if key in self.pyramids:
+            self.pyramids.move_to_end(key)
+            return self.pyramids[key]
+        pyramid = PreviewPyramid()
+        self.pyramids[key] = pyramid
+        weakref.finalize(img, self.pyramids.pop, key, None)
+        while len(self.pyramids) > self.size:
+            self.pyramids.popitem(last=False)
+        return pyramid
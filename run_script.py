@@ -0,0 +1,107 @@
+import argparse
+import glob
+import os
+import sys
+from pathlib import Path
+
+import cv2
+
+import func2action
+import filter_script
+import graph_executor
+import batch_processing
+import tiling
+
+
+def collect_paths(inputs):
+    paths = []
+    for inp in inputs:
+        if os.path.isdir(inp):
+            paths += sorted(str(path) for path in Path(inp).iterdir()
+                            if path.is_file() and (path.suffix == '.npy' or cv2.haveImageReader(str(path))))
+        elif os.path.isfile(inp):
+            paths.append(inp)
+        else:
+            paths += sorted(glob.glob(inp))
+    return paths
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run a saved filter script without the GUI")
+    parser.add_argument("script", help="script saved by the constructor or a saved filters sequence")
+    parser.add_argument("inputs", nargs='+', help="images, directories or glob patterns")
+    parser.add_argument("-o", "--output", default=".", help="directory for the processed images")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--filters", help="python file with additional filters")
+    parser.add_argument("--depth", action='store_true',
+                        help="read 16 bit and float images as they are (IMREAD_UNCHANGED) and keep their type")
+    parser.add_argument("--tile", type=int, help="process every image by tiles of this size into memory mapped "
+                                                 ".npy files, for images larger than memory")
+    return parser.parse_args(argv)
+
+
+def read_flags(args):
+    return cv2.IMREAD_UNCHANGED if args.depth else cv2.IMREAD_COLOR
+
+
+def run_tiled(plan, paths, args):
+    errors = 0
+    for path in paths:
+        name = Path(path).stem + '.npy'
+        out_paths = [str(Path(args.output) / batch_processing.result_name(name, i))
+                     for i in range(len(plan.result_slots))]
+        try:
+            tiling.run_tiled(plan, tiling.open_image(path, read_flags(args)), out_paths, args.tile, args.workers)
+        except graph_executor.GraphError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 2
+        except Exception as e:
+            errors += 1
+            print(f"Error: {path}: {e}", file=sys.stderr)
+            continue
+        print(f"{path} -> {', '.join(Path(out_path).name for out_path in out_paths)}")
+    return 1 if errors else 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    extra_funcs = func2action.all_func_from_file(args.filters) if args.filters else None
+    try:
+        nodes, edges = filter_script.read_script(args.script, filter_script.script_funcs(extra_funcs))
+        plan = graph_executor.compile_plan(nodes, edges)
+    except graph_executor.GraphError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    for names in plan.fused():
+        print(f"Fused: {names}", file=sys.stderr)
+
+    paths = collect_paths(args.inputs)
+    os.makedirs(args.output, exist_ok=True)
+
+    if args.tile:
+        return run_tiled(plan, paths, args)
+
+    # filters loaded from a file can't be imported by worker processes
+    workers = 1 if extra_funcs else args.workers
+    if paths:
+        try:
+            peak = batch_processing.estimate_peak(plan, paths[0], workers, read_flags(args))
+            print(f"Estimated peak memory: {peak / 2**20:.0f} MiB", file=sys.stderr)
+        except Exception as e:
+            print(f"Peak memory can't be estimated: {e}", file=sys.stderr)
+    processor = batch_processing.make_processor(plan, paths, args.output, workers, read_flags(args))
+    processor.start()
+    while not processor.finished():
+        for path, names in processor.wait():
+            if names is not None:
+                print(f"{path} -> {', '.join(names)}")
+    for path, error in processor.errors:
+        print(f"Error: {path}: {error}", file=sys.stderr)
+
+    return 1 if processor.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
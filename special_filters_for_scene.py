@@ -1,5 +1,8 @@
 import cv2
 import numpy as np
+import suppotr_functions as sup
+# conversions MainWindow runs after every filter, nodes of exported filter sequences
+from suppotr_functions import standart, keep_depth
 
 
 def input(img=None):
@@ -11,24 +14,37 @@ def output(img=None):
 
 
 def split(img=None):
-    return [img.copy(), img.copy()]
+    return [img, img]
 
 
-def bitwise_and(imgs=None):
-    return cv2.bitwise_and(imgs[0], imgs[1])
+def bitwise_and(imgs=None, *, dst=None):
+    if imgs[0].dtype.kind == 'f':
+        return sup.float_bitwise(np.bitwise_and, imgs, out=dst)
+    return cv2.bitwise_and(imgs[0], imgs[1], dst=dst)
 
 
-def bitwise_or(imgs=None):
-    return cv2.bitwise_or(imgs[0], imgs[1])
+def bitwise_or(imgs=None, *, dst=None):
+    if imgs[0].dtype.kind == 'f':
+        return sup.float_bitwise(np.bitwise_or, imgs, out=dst)
+    return cv2.bitwise_or(imgs[0], imgs[1], dst=dst)
 
 
-def bitwise_xor(imgs=None):
-    return cv2.bitwise_xor(imgs[0], imgs[1])
+def bitwise_xor(imgs=None, *, dst=None):
+    if imgs[0].dtype.kind == 'f':
+        return sup.float_bitwise(np.bitwise_xor, imgs, out=dst)
+    return cv2.bitwise_xor(imgs[0], imgs[1], dst=dst)
 
 
-def bitwise_not(img=None):
-    return cv2.bitwise_not(img)
+def bitwise_not(img=None, *, dst=None):
+    # not of a float image in 0..1 is 1 - img, as lut.not_curve
+    if img.dtype.kind == 'f':
+        return np.subtract(sup.depth_max(img.dtype), img, out=dst)
+    return cv2.bitwise_not(img, dst=dst)
 
 
 def sum_with_a_b(imgs=None, a=1, b=1):
-    return a * imgs[0] + b * imgs[1]
+    if imgs[0].dtype == np.uint8:
+        return a * imgs[0] + b * imgs[1]
+    # a 16 bit or float sum keeps the depth of the images instead of becoming a float64 image of 0..255
+    res = np.float32(a) * imgs[0].astype(np.float32) + np.float32(b) * imgs[1].astype(np.float32)
+    return sup.saturate(res, sup.depth_type(imgs[0].dtype))
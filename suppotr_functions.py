@@ -1,14 +1,72 @@
+import threading
+from collections import OrderedDict
+from functools import wraps
+
 import numpy as np
 import cv2
+import scipy.fft
+
+buffers = threading.local()
+# larger padded buffers aren't kept by the thread after the fft
+PAD_BUFFER_BYTES = 64 * 1024**2
+
+
+# white level of the image types carried by the high bit depth mode, float images are in 0..1
+DEPTH_MAX = {np.dtype(np.uint8): 255, np.dtype(np.uint16): 65535, np.dtype(np.float32): 1.0}
+
+
+def depth_max(dtype):
+    return DEPTH_MAX.get(np.dtype(dtype), 255)
+
+
+def depth_type(dtype):
+    # type kept by the high bit depth mode, other types become uint8
+    return np.dtype(dtype) if np.dtype(dtype) in DEPTH_MAX else np.dtype(np.uint8)
+
+
+def saturate(image, dtype=np.uint8, *, out=None):
+    # saturating conversion in one pass, an integer image of this type is returned as is (or copied into out),
+    # float images are in 0..1 and are always cut to it
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        if out is None:
+            out = np.empty(image.shape, dtype=dtype)
+        np.clip(image, 0, 1, out=out, casting='unsafe')
+        return out
+    if image.dtype == dtype:
+        if out is None:
+            return image
+        np.copyto(out, image)
+        return out
+    if out is None:
+        out = np.empty(image.shape, dtype=dtype)
+    if np.can_cast(image.dtype, dtype):
+        np.copyto(out, image, casting='unsafe')
+    else:
+        info = np.iinfo(dtype)
+        np.clip(image, info.min, info.max, out=out, casting='unsafe')
+    return out
 
 
-def standart(image=None):
-    image2 = image.copy()
-    image2[image2 < 0.0] = 0.0
-    image2[image2 > 255.0] = 255.0
-    image2 = image2.astype(np.uint8)
+def standart(image=None, *, out=None):
+    return saturate(image, np.uint8, out=out)
 
-    return image2
+
+def keep_depth(image=None, *, out=None):
+    # standart of the high bit depth mode, uint16 and float32 images keep their type
+    return saturate(image, depth_type(image.dtype), out=out)
+
+
+def float_bitwise(ufunc, imgs, out=None):
+    # bitwise operation of float images in 0..1 done on them as 16 bit images, not on the bits of the floats
+    a, b = (saturate(np.rint(img * 65535), np.uint16) for img in imgs)
+    return saturate(ufunc(a, b) / 65535, imgs[0].dtype, out=out)
+
+
+def from_8bit(image, dtype):
+    # values given in 0..255 as an image of the depth of dtype, as if the filter was applied to an uint8 image
+    dtype = depth_type(dtype)
+    return saturate(image if dtype == np.uint8 else image * (depth_max(dtype) / 255), dtype)
 
 
 def DFT(img):
@@ -20,47 +78,147 @@ def DFT(img):
     #cv2.normalize(magnitude_spectrum, magnitude_spectrum, 0, 1, cv2.NORM_MINMAX)
     #return magnitude_spectrum, dft_shift
 
-    dft = np.fft.fft2(img)
-    dft = np.fft.fftshift(dft)
+    dft = scipy.fft.fft2(np.float32(img), axes=(0, 1), workers=fft_workers())
+    dft = scipy.fft.fftshift(dft, axes=(0, 1))
     eps = 10**(-6)
-    mag = np.log(np.abs(dft) + eps).copy()
+    mag = np.abs(dft)
+    mag += eps
+    np.log(mag, out=mag)
     cv2.normalize(mag, mag, 0, 255, cv2.NORM_MINMAX)
     return mag, dft
 
 
-def iDFT(fimg):
+def fft_workers():
+    # as many fft threads as opencv uses, process pool workers set it to 1 so they don't oversubscribe the cpu
+    return max(1, cv2.getNumThreads())
+
+
+def optimal_dft_shape(shape):
+    return cv2.getOptimalDFTSize(shape[0]), cv2.getOptimalDFTSize(shape[1])
+
+
+def pad_buffer(shape, keep=True):
+    # one float32 buffer per thread, reused while the image size doesn't change. Buffers of stacks (keep=False)
+    # and buffers above PAD_BUFFER_BYTES are new every time, so a pool thread doesn't hold them after the call.
+    if not keep or np.prod(shape) * 4 > PAD_BUFFER_BYTES:
+        return np.empty(shape, dtype=np.float32)
+    buf = getattr(buffers, 'padded', None)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype=np.float32)
+        buffers.padded = buf
+    return buf
+
+
+def freq_filter(img, mask, log=False, stacked=False, scale=1):
+    # |ifft(fft(img) * mask)| with a real fft in float32. The image is reflected up to an optimal dft size,
+    # the mask is built for the unshifted half spectrum, so no fftshift is needed.
+    # Channels are moved to the front and transformed as one batch, a stacked img is N x H x W (x C)
+    # and all its images are transformed in the same batch. The image is multiplied by scale before the log.
+    spatial = 1 if stacked else 0
+    n, m = img.shape[spatial:spatial + 2]
+    channels = img.ndim == spatial + 3
+    pn, pm = optimal_dft_shape((n, m))
+    src = np.moveaxis(img, -1, spatial) if channels else img
+    padded = pad_buffer(src.shape[:-2] + (pn, pm), keep=not stacked)
+
+    padded[..., :n, :m] = src
+    if scale != 1:
+        padded[..., :n, :m] *= scale
+    if log:
+        padded[..., :n, :m] += 10**(-6)
+        np.log(padded[..., :n, :m], out=padded[..., :n, :m])
+    if pn > n:
+        padded[..., n:, :m] = padded[..., 2 * n - pn:n, :m][..., ::-1, :]
+    if pm > m:
+        padded[..., m:] = padded[..., 2 * m - pm:m][..., ::-1]
+
+    spectrum = scipy.fft.rfft2(padded, workers=fft_workers())
+    spectrum *= mask
+    res = scipy.fft.irfft2(spectrum, s=(pn, pm), workers=fft_workers())
+
+    out = np.empty(img.shape, dtype=np.float32)
+    np.abs(res[..., :n, :m], out=np.moveaxis(out, -1, spatial) if channels else out)
+    return out
+
+
+class ArrayCache:
+    # read-only arrays by the arguments of the function making them, least recently used ones
+    # are dropped above max_bytes, an array larger than max_bytes isn't kept
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, func):
+        @wraps(func)
+        def cached(*args):
+            with self.lock:
+                if args in self.entries:
+                    self.entries.move_to_end(args)
+                    return self.entries[args]
+            arr = func(*args)
+            self.put(args, arr)
+            return arr
+
+        cached.cache_clear = self.clear
+        return cached
+
+    def put(self, key, arr):
+        if arr.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = arr
+            self.n_bytes += arr.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.n_bytes -= old.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+
+# the masks of a 40 MP frame are about 80 MB each, the caches are limited by bytes, not by the number of masks
+@ArrayCache(128 * 1024**2)
+def freq_distance(n, m):
+    # distance to the zero frequency on the rfft2 grid of the padded image, in frequency units of the (n, m) image
+    pn, pm = optimal_dft_shape((n, m))
+    i = np.fft.fftfreq(pn).astype(np.float32) * n
+    j = np.fft.rfftfreq(pm).astype(np.float32) * m
+    d = euclid_norm(i[:, None], j[None, :])
+    d.flags.writeable = False
+    return d
 
-    #f_ishift = np.fft.ifftshift(fshift)
-    #img_back = cv2.idft(f_ishift)
-    #img_back = cv2.magnitude(img_back[:, :, 0], img_back[:, :, 1])
-    #cv2.normalize(img_back, img_back, 0, 1, cv2.NORM_MINMAX)
-    #return img_back
 
-    fimg = np.fft.ifftshift(fimg)
-    img = np.fft.ifft2(fimg)
-    img = np.abs(img).copy()
-    cv2.normalize(img, img, 0, 255, cv2.NORM_MINMAX)
-    return img
+@ArrayCache(256 * 1024**2)
+def freq_mask(kind, shape, dtype, d_0, gamma_l=None, gamma_h=None):
+    n, m = shape
+    d = freq_distance(n, m)
+    if kind == 'ideal':
+        h = (d > d_0).astype(dtype)
+    else:
+        h = 1 - np.exp(-(d**2)/(2*(d_0**2)))
+        if kind == 'homomorf':
+            h = (gamma_h - gamma_l) * h + gamma_l
+        h = h.astype(dtype, copy=False)
+    h.flags.writeable = False
+    return h
 
 
 def gauss_high_freq_mask(img, d_0):
-    n, m = img.shape
-    d = np.fromfunction(lambda i, j: euclid_norm(i-n/2, j-m/2), (n, m), dtype=np.float32)
-    h = 1 - np.exp(-(d**2)/(2*(d_0**2)))
-    return h
+    return freq_mask('gauss', img.shape[:2], np.float32, d_0)
 
 
 def ideal_high_freq_mask(img, d_0):
-    n, m = img.shape
-    d = np.fromfunction(lambda i, j:  euclid_norm(i-n/2, j-m/2), (n, m))
-    d = (d > d_0).astype(int)
-    return d
+    return freq_mask('ideal', img.shape[:2], np.float32, d_0)
 
 
 def homomorf_mask(img, d_0, gamma_l, gamma_h):
-    gauss_h = gauss_high_freq_mask(img, d_0)
-    h = (gamma_h - gamma_l) * gauss_h + gamma_l
-    return h
+    return freq_mask('homomorf', img.shape[:2], np.float32, d_0, gamma_l, gamma_h)
 
 
 def euclid_norm(x, y):
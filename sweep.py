@@ -0,0 +1,287 @@
+import argparse
+import csv
+import multiprocessing
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from inspect import signature, Parameter
+from math import ceil, prod
+from pathlib import Path
+
+import numpy as np
+import cv2
+
+import func2action
+import filter_script
+import graph_executor
+import batch_processing
+import run_script
+from graph_executor import GraphError, GraphNode, io_points
+from suppotr_functions import standart
+
+THUMB_SIZE = 256
+LABEL_LINE = 16
+
+worker_plans = None
+
+
+class SweepParam:
+    def __init__(self, node, arg, values):
+        self.node = node
+        self.arg = arg
+        self.values = values
+
+    @property
+    def name(self):
+        return f"{self.node.name}.{self.arg}"
+
+
+def parse_values(text):
+    # "start:stop:step" (stop included) or "v1,v2,..."
+    if ':' in text:
+        start, stop, step = (float(x) for x in text.split(':'))
+        if step <= 0:
+            raise ValueError(f"Incorrect step in {text}")
+        values = np.arange(start, stop + step / 2, step)
+        return [f"{value:g}" for value in values]
+    return [value.strip() for value in text.split(',') if value.strip()]
+
+
+def parse_param(text, nodes):
+    # "[node.]arg=values", node is a filter name or an index of the node in the script
+    try:
+        target, values = text.split('=', 1)
+        values = parse_values(values)
+    except ValueError:
+        raise GraphError(f"Incorrect parameter {text}")
+    node_name, _, arg = target.rpartition('.')
+    filter_nodes = [node for node in nodes if node.n_in > 0 and node.n_out > 0]
+    if node_name == '':
+        candidates = filter_nodes if len(filter_nodes) == 1 else [node for node in filter_nodes if arg in node.args]
+    elif node_name.isdigit() and int(node_name) < len(nodes):
+        candidates = [nodes[int(node_name)]]
+    else:
+        candidates = [node for node in filter_nodes if node.name == node_name]
+    if len(candidates) != 1:
+        raise GraphError(f"Can't find one node for {text}, give the index of the node in the script")
+    return SweepParam(candidates[0], arg, values)
+
+
+def filter_graph(func):
+    # input -> filter -> output, arguments without a value keep the defaults of the filter
+    params = signature(func.func).parameters
+    args = {arg: str(params[arg].default) for arg in func.args
+            if params[arg].default not in (None, Parameter.empty)}
+    nodes = [GraphNode('input', None, {}, 0, 1),
+             GraphNode(func.name, func.func, args, *io_points(func.name)),
+             GraphNode('output', None, {}, 1, 0)]
+    edges = [(nodes[0], 0, nodes[1], 0), (nodes[1], 0, nodes[2], 0)]
+    return nodes, edges
+
+
+def combinations(params, samples=None, seed=None):
+    # lexicographic order with the most upstream parameter changing slowest,
+    # so neighbouring combinations share the longest computed prefix of the graph
+    sizes = [len(param.values) for param in params]
+    total = prod(sizes)
+    if samples is None or samples >= total:
+        indices = range(total)
+    else:
+        indices = sorted(random.Random(seed).sample(range(total), samples))
+
+    combos = []
+    for index in indices:
+        combo = []
+        for size in reversed(sizes):
+            combo.append(index % size)
+            index //= size
+        combos.append(tuple(param.values[i] for param, i in zip(params, reversed(combo))))
+    return combos
+
+
+def make_plans(nodes, edges, params, combos):
+    saved = [param.node.args.get(param.arg) for param in params]
+    plans = []
+    try:
+        for combo in combos:
+            for param, value in zip(params, combo):
+                param.node.args[param.arg] = value
+            plans.append(graph_executor.compile_plan(nodes, edges))
+    finally:
+        for param, value in zip(params, saved):
+            if value is None:
+                param.node.args.pop(param.arg, None)
+            else:
+                param.node.args[param.arg] = value
+    return plans
+
+
+def run_combinations(plans, img, cache=None):
+    # the plans have the same steps and differ only in arguments, a step with the same arguments
+    # on the same inputs as in an earlier plan takes its result from the cache, as views in the constructor do
+    cache = cache if cache is not None else graph_executor.ResultCache()
+    key = graph_executor.img_key(img)
+    for plan in plans:
+        yield plan.run(img, cache, key)
+
+
+def thumbnail(img):
+    scale = THUMB_SIZE / max(img.shape[:2])
+    if scale < 1:
+        img = cv2.resize(img, (max(1, int(img.shape[1] * scale)), max(1, int(img.shape[0] * scale))),
+                         interpolation=cv2.INTER_AREA)
+    return img
+
+
+def init_worker(plans):
+    global worker_plans
+    worker_plans = plans
+    cv2.setNumThreads(1)
+
+
+def sweep_file(path, indices, plans=None):
+    plans = plans if plans is not None else worker_plans
+    specs = func2action.all_spec()
+    img = batch_processing.read_img(path)
+    rows = []
+    for index, res_imgs in zip(indices, run_combinations([plans[i] for i in indices], img)):
+        res_imgs = [standart(res_img) for res_img in res_imgs]
+        metrics = [{spec.name: spec.func(res_img) for spec in specs} for res_img in res_imgs]
+        rows.append((index, [thumbnail(res_img) for res_img in res_imgs], metrics))
+    return rows
+
+
+def contact_sheet(thumbs, labels, columns=None):
+    columns = columns if columns else ceil(len(thumbs) ** 0.5)
+    rows = ceil(len(thumbs) / columns)
+    label_h = LABEL_LINE * max(len(label) for label in labels) + 4
+    cell_h = THUMB_SIZE + label_h
+    sheet = np.full((rows * cell_h, columns * THUMB_SIZE, 3), 255, np.uint8)
+    for i, (thumb, label) in enumerate(zip(thumbs, labels)):
+        y, x = (i // columns) * cell_h, (i % columns) * THUMB_SIZE
+        if thumb.ndim == 2:
+            thumb = cv2.cvtColor(thumb, cv2.COLOR_GRAY2BGR)
+        sheet[y:y + thumb.shape[0], x:x + thumb.shape[1]] = thumb[..., :3]
+        for k, line in enumerate(label):
+            cv2.putText(sheet, line, (x + 2, y + THUMB_SIZE + LABEL_LINE * (k + 1)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 1, cv2.LINE_AA)
+    return sheet
+
+
+class Sweep:
+    def __init__(self, nodes, edges, params, samples=None, seed=None):
+        order = graph_executor.topological_order(nodes, edges)
+        self.params = sorted(params, key=lambda param: order.index(param.node))
+        self.combos = combinations(self.params, samples, seed)
+        self.plans = make_plans(nodes, edges, self.params, self.combos)
+
+    def tasks(self, paths, workers):
+        # Combinations of an image are split into contiguous chunks, enough to keep all workers busy.
+        # A chunk starts only where an upstream parameter changes, so the steps shared by the combinations
+        # of a chunk run once in it. One worker takes all combinations of an image as one chunk.
+        if not self.combos:
+            return
+        groups = [i for i in range(1, len(self.combos)) if self.combos[i][:-1] != self.combos[i - 1][:-1]]
+        chunks = 1 if workers == 1 else max(1, min(len(groups) + 1, ceil(2 * workers / max(1, len(paths)))))
+        size = ceil(len(self.combos) / chunks)
+        starts = [0]
+        for start in groups:
+            if start - starts[-1] >= size:
+                starts.append(start)
+        bounds = starts + [len(self.combos)]
+        for path in paths:
+            for start, stop in zip(bounds, bounds[1:]):
+                yield path, list(range(start, stop))
+
+    def run(self, paths, workers=None):
+        # yields (path, combination index, thumbnails, metrics) in the order of the results
+        workers = workers if workers else os.cpu_count()
+        if workers == 1:
+            for path, indices in self.tasks(paths, 1):
+                for row in sweep_file(path, indices, self.plans):
+                    yield (path,) + row
+            return
+
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_worker, initargs=(self.plans,)) as executor:
+            futures = [(path, executor.submit(sweep_file, path, indices))
+                       for path, indices in self.tasks(paths, workers)]
+            for path, future in futures:
+                for row in future.result():
+                    yield (path,) + row
+
+    def labels(self, index):
+        return [f"{param.name}={value}" for param, value in zip(self.params, self.combos[index])]
+
+    def save(self, results, save_dir):
+        # one contact sheet per image and output, one table row per image, combination and output
+        specs = [spec.name for spec in func2action.all_spec()]
+        sheets = dict()
+        with open(Path(save_dir) / "sweep.csv", 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["image", "combination"] + [param.name for param in self.params] + ["output"] + specs)
+            for path, index, thumbs, metrics in results:
+                for i, (thumb, values) in enumerate(zip(thumbs, metrics)):
+                    writer.writerow([Path(path).name, index] + list(self.combos[index]) + [i]
+                                    + [values[spec] for spec in specs])
+                    sheets.setdefault((path, i), []).append((thumb, self.labels(index)))
+
+        names = []
+        for (path, i), cells in sheets.items():
+            name = batch_processing.result_name(Path(path).stem + "_sweep.png", i)
+            cv2.imwrite(str(Path(save_dir) / name), contact_sheet(*zip(*cells)))
+            names.append(name)
+        return names
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Try combinations of filter arguments on test images")
+    parser.add_argument("graph", help="script saved by the constructor or the name of a filter")
+    parser.add_argument("inputs", nargs='+', help="images, directories or glob patterns")
+    parser.add_argument("-p", "--param", action='append', required=True,
+                        help="[node.]arg=start:stop:step or [node.]arg=v1,v2,..., "
+                             "node is a filter name or the index of the node in the script")
+    parser.add_argument("-n", "--samples", type=int, help="number of random combinations instead of all")
+    parser.add_argument("--seed", type=int, help="seed of the random combinations")
+    parser.add_argument("-o", "--output", default=".", help="directory for the contact sheets and the table")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--filters", help="python file with additional filters")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    extra_funcs = func2action.all_func_from_file(args.filters) if args.filters else None
+    funcs = filter_script.script_funcs(extra_funcs)
+    try:
+        if os.path.isfile(args.graph):
+            nodes, edges = filter_script.read_script(args.graph, funcs)
+        elif args.graph in funcs:
+            nodes, edges = filter_graph(funcs[args.graph])
+        else:
+            raise GraphError(f"{args.graph} is neither a script nor a filter")
+        sweep = Sweep(nodes, edges, [parse_param(param, nodes) for param in args.param], args.samples, args.seed)
+    except GraphError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    paths = run_script.collect_paths(args.inputs)
+    os.makedirs(args.output, exist_ok=True)
+    print(f"{len(sweep.combos)} combinations, {len(paths)} images", file=sys.stderr)
+
+    # filters loaded from a file can't be imported by worker processes
+    workers = 1 if extra_funcs else args.workers
+    try:
+        names = sweep.save(sweep.run(paths, workers), args.output)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    for name in names:
+        print(name)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
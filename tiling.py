@@ -0,0 +1,160 @@
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+
+import numpy as np
+import cv2
+
+import filters
+from graph_executor import ExecutionPlan, GraphError, LutStep, Step
+from lut import filter_args
+
+
+def gaussian_halo(kernel_size=3, sigma=0):
+    # opencv takes the kernel size from sigma when kernel_size is 0, its radius is 3 sigma for uint8 images
+    # and 4 sigma for the other types
+    return max(int(kernel_size), ceil(4 * float(sigma)) + 1)
+
+
+def bilateral_halo(kernel_size=5, sigma_color=75, sigma_space=75):
+    return int(kernel_size) if int(kernel_size) > 0 else ceil(1.5 * float(sigma_space)) + 1
+
+
+# filter (module, name) -> function giving the overlap in pixels the filter needs from the filter arguments
+TILE_HALO = {
+    ('filters', 'gaussian_blur'): gaussian_halo,
+    ('filters', 'average_blur'): lambda kernel_size=3: int(kernel_size),
+    ('filters', 'bilateral_filter'): bilateral_halo,
+    ('filters', 'sob'): lambda: 3,
+    ('filters', 'laplasiian'): lambda: 3,
+    ('filters', 'gamma_correction'): lambda gamma=2.5: 0,
+    ('filters', 'linear_hist_transform'): lambda k=1, b=0: 0,
+    ('filters', 'piecewise_linear_3_transform'): lambda x1=0.5, y1=0.5, x2=0.5, y2=0.5: 0,
+    ('filters', 'thresholding'): lambda threshold=125: 0,
+    ('filters', 'gray'): lambda: 0,
+    ('special_filters_for_scene', 'split'): lambda: 0,
+    ('special_filters_for_scene', 'bitwise_and'): lambda: 0,
+    ('special_filters_for_scene', 'bitwise_or'): lambda: 0,
+    ('special_filters_for_scene', 'bitwise_xor'): lambda: 0,
+    ('special_filters_for_scene', 'bitwise_not'): lambda: 0,
+    ('special_filters_for_scene', 'sum_with_a_b'): lambda a=1, b=1: 0,
+    ('suppotr_functions', 'standart'): lambda: 0,
+    ('suppotr_functions', 'keep_depth'): lambda: 0,
+}
+
+# these need the whole image (global statistics, fft) or change its geometry
+NON_TILEABLE = {
+    ('filters', 'gradation_correction'),
+    ('filters', 'equalization_hist'),
+    ('filters', 'DFT'),
+    ('filters', 'homomorf_filtering'),
+    ('filters', 'gauss_high_freq_filter'),
+    ('filters', 'ideal_high_freq_filter'),
+    ('filters', 'resize'),
+    ('filters', 'exact_crop'),
+    ('filters', 'rotate_img'),
+}
+
+
+def filter_halo(func, args):
+    key = (getattr(func, '__module__', None), getattr(func, '__name__', None))
+    if key in NON_TILEABLE or key not in TILE_HALO:
+        return None
+    return TILE_HALO[key](**filter_args(func, args))
+
+
+def plan_halo(plan):
+    halo = 0
+    not_tileable = []
+    for step in plan.steps:
+        if isinstance(step, LutStep):
+            continue
+        step_halo = filter_halo(step.func, step.args)
+        if step_halo is None:
+            not_tileable.append(step.name)
+        else:
+            halo += step_halo
+    if not_tileable:
+        raise GraphError(f"Can't process by tiles: {', '.join(not_tileable)}")
+    return halo
+
+
+def open_image(path, flags=cv2.IMREAD_COLOR):
+    # .npy files are memory mapped, so images larger than ram can be tiled
+    if str(path).endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    img = cv2.imread(str(path), flags)
+    if img is None:
+        raise IOError(f"Can't read image {path}")
+    return img
+
+
+def run_tiled(plan, img, out_paths, tile_size=2048, workers=None):
+    halo = plan_halo(plan)
+    h, w = img.shape[:2]
+    tiles = [(y, x) for y in range(0, h, tile_size) for x in range(0, w, tile_size)]
+    outputs = []
+
+    def process_tile(tile):
+        y, x = tile
+        th, tw = min(tile_size, h - y), min(tile_size, w - x)
+        y0, x0 = max(0, y - halo), max(0, x - halo)
+        y1, x1 = min(h, y + th + halo), min(w, x + tw + halo)
+        res = plan.run(np.ascontiguousarray(img[y0:y1, x0:x1]))
+        res = [res_img[y - y0:y - y0 + th, x - x0:x - x0 + tw] for res_img in res]
+        if any(res_img.shape[:2] != (th, tw) for res_img in res):
+            raise GraphError("The graph changes the image size and can't be processed by tiles")
+        return res
+
+    def write_tile(tile, res):
+        y, x = tile
+        for output, res_img in zip(outputs, res):
+            output[y:y + res_img.shape[0], x:x + res_img.shape[1]] = res_img
+
+    # the first tile gives the number, type and channels of the outputs
+    first = process_tile(tiles[0])
+    if len(first) != len(out_paths):
+        raise GraphError(f"The graph has {len(first)} outputs, {len(out_paths)} paths given")
+    for path, res_img in zip(out_paths, first):
+        outputs.append(np.lib.format.open_memmap(path, mode='w+', dtype=res_img.dtype,
+                                                 shape=(h, w) + res_img.shape[2:]))
+    write_tile(tiles[0], first)
+
+    # tiles don't overlap in the output, so every worker writes its own tile
+    with ThreadPoolExecutor(workers if workers else os.cpu_count()) as executor:
+        list(executor.map(lambda tile: write_tile(tile, process_tile(tile)), tiles[1:]))
+
+    for output in outputs:
+        output.flush()
+    return outputs
+
+
+def seam_diff(plan, img, tile_size):
+    # largest difference of the tiled result from the result of the whole image
+    with tempfile.TemporaryDirectory() as tmp:
+        out_paths = [os.path.join(tmp, f"{i}.npy") for i in range(len(plan.result_slots))]
+        tiled = run_tiled(plan, img, out_paths, tile_size, 1)
+        diff = max(np.abs(tiled_img.astype(np.float64) - img_res.astype(np.float64)).max()
+                   for tiled_img, img_res in zip(tiled, plan.run(img)))
+        del tiled
+    return diff
+
+
+def check_seams(size=300, tile_size=64):
+    # tiled gaussian blur of every image depth against the whole image, the seams have to be invisible
+    rng = np.random.default_rng(0)
+    base = rng.random((size, size, 3), dtype=np.float32)
+    imgs = [(base * 255).astype(np.uint8), (base * 65535).astype(np.uint16), base]
+    for sigma in (1, 2.5, 4):
+        plan = ExecutionPlan([Step("gaussian blur", filters.gaussian_blur, {'kernel_size': 0, 'sigma': sigma},
+                                   [0], [1], 1, 1)], 2, [0], [1])
+        for img in imgs:
+            print(f"sigma {sigma:<5}{str(img.dtype):<9}max diff {seam_diff(plan, img, tile_size)}")
+
+
+if __name__ == '__main__':
+    # python tiling.py [image size] [tile size]
+    size, tile_size = (int(arg) for arg in (sys.argv[1:] + ["300", "64"][len(sys.argv) - 1:])[:2])
+    check_seams(size, tile_size)